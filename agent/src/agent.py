@@ -5,19 +5,37 @@ Integrates with Zep for user memory and knowledge graphs.
 """
 
 import os
+import re
+import hashlib
 import sys
 import json
-from typing import Optional
-from dataclasses import dataclass
-
-from fastapi import FastAPI, Request
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Optional, Union
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from starlette.responses import StreamingResponse
-from pydantic import BaseModel
-from pydantic_ai import Agent
+from starlette.responses import FileResponse, StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field, PrivateAttr, ValidationError, field_serializer, field_validator
+from pydantic_ai import Agent, ToolReturn
 from pydantic_ai.models.google import GoogleModel
+from pydantic_ai.providers.google import GoogleProvider
 from pydantic_ai.result import RunContext
 from pydantic_ai.ag_ui import StateDeps
+from pydantic_ai.messages import ModelRequest, UserPromptPart
+
+from .calculator import CalculationResult, calculate_stamp_duty
+from .jobs import job_manager, job_store
+from .knowledge import KnowledgeIndex
+from .profiling import PROFILE_ENABLED, ProfilingMiddleware, profile_store
+from .tracing import TRACE_CAPTURE_DIR, RecordingModel, TraceCaptureMiddleware, record_identity, record_source
+from .transport import ClientPool, ZEP_POOL
+from .resilience import BreakerSettings, CircuitBreaker, CircuitOpenError
+from .state_sync import state_sync_events
+from .usage import UsageMiddleware, UsageModel, current_usage, record_usage_identity, usage_ledger
 
 # Zep for user memory
 from zep_cloud.client import Zep
@@ -30,15 +48,57 @@ import psycopg2
 from dotenv import load_dotenv
 load_dotenv()
 
-# Initialize Zep client
+# Pooled HTTP clients for Gemini and Zep (opened/closed by the app lifespan)
+http_pools = ClientPool()
+GEMINI_MODEL = os.environ.get("GEMINI_MODEL", "gemini-2.0-flash")
+GEMINI_BASE_URL = os.environ.get("GEMINI_BASE_URL")  # e.g. a local stand-in server
+
+# Zep client (created in the lifespan on the pooled transport)
 ZEP_API_KEY = os.environ.get("ZEP_API_KEY")
+ZEP_BASE_URL = os.environ.get("ZEP_BASE_URL")
 ZEP_GRAPH_ID = "stamp_duty_calculator"
-zep_client = Zep(api_key=ZEP_API_KEY) if ZEP_API_KEY else None
+zep_client: Optional[Zep] = None
+
+
+def build_zep_client() -> Optional[Zep]:
+    """Create the Zep client on the pooled keep-alive transport."""
+    if not ZEP_API_KEY:
+        return None
+    return Zep(
+        api_key=ZEP_API_KEY,
+        base_url=ZEP_BASE_URL,
+        httpx_client=http_pools.zep_http,
+        timeout=ZEP_POOL.read_timeout,
+    )
 
 # Initialize Neon database
 DATABASE_URL = os.environ.get("DATABASE_URL")
+NEON_CONNECT_TIMEOUT = int(os.environ.get("NEON_CONNECT_TIMEOUT_SECONDS", "5"))
 print(f"[INIT] Database URL configured: {bool(DATABASE_URL)}", file=sys.stderr)
 
+
+def db_connect():
+    return psycopg2.connect(DATABASE_URL, connect_timeout=NEON_CONNECT_TIMEOUT)
+
+
+# One circuit breaker + bulkhead per dependency; while open, memory/persistence is skipped
+zep_breaker = CircuitBreaker("zep", BreakerSettings.from_env(
+    "ZEP",
+    window_seconds=60.0, min_calls=5, failure_rate=0.5, open_seconds=30.0,
+    half_open_probes=1, max_concurrent=8, call_timeout=5.0,
+), expected_errors=(NotFoundError,))
+neon_breaker = CircuitBreaker("neon", BreakerSettings.from_env(
+    "NEON",
+    window_seconds=60.0, min_calls=5, failure_rate=0.5, open_seconds=30.0,
+    half_open_probes=1, max_concurrent=8, call_timeout=5.0,
+))
+
+# Knowledge snippets (markdown directory + mdx_content table)
+KNOWLEDGE_DIR = Path(os.environ.get("KNOWLEDGE_DIR", Path(__file__).resolve().parent.parent / "knowledge"))
+KNOWLEDGE_TOP_K = int(os.environ.get("KNOWLEDGE_TOP_K", "3"))
+KNOWLEDGE_REFRESH_SECONDS = float(os.environ.get("KNOWLEDGE_REFRESH_SECONDS", "300"))
+knowledge_index = KnowledgeIndex()
+
 # ============================================================================
 # ZEP USER MEMORY HELPERS
 # ============================================================================
@@ -48,6 +108,15 @@ async def get_or_create_zep_user(user_id: str, email: str = None, name: str = No
     if not zep_client:
         return None
 
+    # The Zep SDK is blocking - run it off the event loop, behind the breaker
+    try:
+        return await zep_breaker.call(_get_or_create_zep_user_sync, user_id, email, name)
+    except Exception as e:
+        print(f"Zep user error: {e!r}")
+        return None
+
+
+def _get_or_create_zep_user_sync(user_id: str, email: str = None, name: str = None):
     try:
         user = zep_client.user.get(user_id)
         return user
@@ -62,9 +131,6 @@ async def get_or_create_zep_user(user_id: str, email: str = None, name: str = No
             last_name=last_name
         )
         return zep_client.user.get(user_id)
-    except Exception as e:
-        print(f"Zep user error: {e}")
-        return None
 
 
 async def get_user_context(user_id: str) -> str:
@@ -72,16 +138,10 @@ async def get_user_context(user_id: str) -> str:
     if not zep_client:
         return ""
 
-    try:
-        # Get user facts from knowledge graph
-        context = zep_client.user.get_context(user_id, min_score=0.5)
-        if context and context.facts:
-            facts = [f.fact for f in context.facts[:5]]  # Top 5 facts
-            return "Known about this user: " + "; ".join(facts)
-        return ""
-    except Exception as e:
-        print(f"Zep context error: {e}")
-        return ""
+    facts = await load_zep_facts(user_id)
+    if facts:
+        return "Known about this user: " + "; ".join(facts)
+    return ""
 
 
 async def add_conversation_to_zep(user_id: str, user_msg: str, assistant_msg: str):
@@ -91,150 +151,168 @@ async def add_conversation_to_zep(user_id: str, user_msg: str, assistant_msg: st
 
     try:
         # Add to user's graph (creates user graph if doesn't exist)
-        zep_client.graph.add(
+        await zep_breaker.call(
+            zep_client.graph.add,
             user_id=user_id,
             type="message",
             data=f"User asked: {user_msg}\nAssistant answered: {assistant_msg}"
         )
         print(f"Zep: Stored conversation for user {user_id[:8]}...")
     except Exception as e:
-        print(f"Zep add error: {e}")
+        print(f"Zep add error: {e!r}")
 
 
 # ============================================================================
-# STAMP DUTY CALCULATION LOGIC
+# USER PROFILE CACHE (read-through, invalidated by write tools)
 # ============================================================================
 
-# England/NI SDLT Rates (2024/25)
-ENGLAND_STANDARD_BANDS = [
-    (250000, 0.0),      # 0% up to £250,000
-    (925000, 0.05),     # 5% £250,001 to £925,000
-    (1500000, 0.10),    # 10% £925,001 to £1,500,000
-    (float('inf'), 0.12) # 12% above £1,500,000
-]
-
-ENGLAND_FIRST_TIME_BANDS = [
-    (425000, 0.0),      # 0% up to £425,000 (first-time buyers)
-    (625000, 0.05),     # 5% £425,001 to £625,000
-]
-
-ENGLAND_ADDITIONAL_SURCHARGE = 0.05  # 5% surcharge on additional properties (increased from 3%)
-
-# Scotland LBTT Rates
-SCOTLAND_STANDARD_BANDS = [
-    (145000, 0.0),      # 0% up to £145,000
-    (250000, 0.02),     # 2% £145,001 to £250,000
-    (325000, 0.05),     # 5% £250,001 to £325,000
-    (750000, 0.10),     # 10% £325,001 to £750,000
-    (float('inf'), 0.12) # 12% above £750,000
-]
-
-SCOTLAND_FIRST_TIME_BANDS = [
-    (175000, 0.0),      # 0% up to £175,000 (first-time buyers)
-    (250000, 0.02),
-    (325000, 0.05),
-    (750000, 0.10),
-    (float('inf'), 0.12)
-]
-
-SCOTLAND_ADS = 0.06  # Additional Dwelling Supplement
-
-# Wales LTT Rates
-WALES_STANDARD_BANDS = [
-    (225000, 0.0),      # 0% up to £225,000
-    (400000, 0.06),     # 6% £225,001 to £400,000
-    (750000, 0.075),    # 7.5% £400,001 to £750,000
-    (1500000, 0.10),    # 10% £750,001 to £1,500,000
-    (float('inf'), 0.12) # 12% above £1,500,000
-]
-
-WALES_HIGHER_RATES_SURCHARGE = 0.04  # 4% surcharge for additional properties
-
-
-def calculate_stamp_duty(
-    price: float,
-    region: str,
-    buyer_type: str
-) -> dict:
+PROFILE_CACHE_TTL = float(os.environ.get("PROFILE_CACHE_TTL", "300"))
+PREFERENCE_TYPES = ('preferred_region', 'buyer_type', 'price_range')
+RECENT_CALCULATIONS_LIMIT = 3
+
+# user_id -> (expires_at, value)
+_profile_cache: dict[str, tuple[float, dict]] = {}
+_zep_facts_cache: dict[str, tuple[float, list]] = {}
+
+
+def _cache_get(cache: dict, user_id: str):
+    entry = cache.get(user_id)
+    if entry and entry[0] > time.monotonic():
+        return entry[1]
+    cache.pop(user_id, None)
+    return None
+
+
+def invalidate_user_cache(user_id: str):
+    """Drop the cached profile after a write for this user (Zep facts expire by TTL, ingestion is async anyway)."""
+    _profile_cache.pop(user_id, None)
+
+
+def _fetch_profile_items(user_id: str) -> list:
+    conn = db_connect()
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT item_type, value, metadata, created_at
+            FROM user_profile_items
+            WHERE user_id = %s
+            ORDER BY created_at DESC
+        """, (user_id,))
+        items = cur.fetchall()
+        cur.close()
+        return items
+    finally:
+        conn.close()
+
+
+async def load_user_profile(user_id: str) -> dict:
+    """
+    Load saved preferences and calculation history from Neon (cached).
+    Returns an empty profile straight away if the Neon breaker is open.
     """
-    Calculate UK stamp duty based on price, region, and buyer type.
+    cached = _cache_get(_profile_cache, user_id)
+    if cached is not None:
+        record_source("profile", cached)
+        return cached
 
-    Args:
-        price: Property purchase price in GBP
-        region: 'england', 'scotland', or 'wales'
-        buyer_type: 'standard', 'first-time', or 'additional'
+    profile = {"preferences": {}, "calculation_history": []}
+    if not DATABASE_URL:
+        return profile
+
+    try:
+        items = await neon_breaker.call(_fetch_profile_items, user_id)
+    except Exception as e:
+        print(f"[CACHE] load_user_profile DB error: {e!r}", file=sys.stderr)
+        return profile
+
+    for item_type, value, metadata, created_at in items:
+        if item_type in PREFERENCE_TYPES:
+            profile["preferences"].setdefault(item_type, value)
+        elif item_type == 'calculation':
+            profile["calculation_history"].append({
+                "value": value,
+                "metadata": metadata,
+                "date": str(created_at)
+            })
+
+    _profile_cache[user_id] = (time.monotonic() + PROFILE_CACHE_TTL, profile)
+    record_source("profile", profile)
+    print(f"[CACHE] load_user_profile: {len(items)} items for user {user_id[:8]}...", file=sys.stderr)
+    return profile
+
+
+async def load_zep_facts(user_id: str) -> list:
+    """
+    Load the top Zep facts for a user (cached).
+    Returns no facts straight away if the Zep breaker is open.
+    """
+    if not zep_client:
+        return []
+
+    cached = _cache_get(_zep_facts_cache, user_id)
+    if cached is not None:
+        record_source("zep_facts", cached)
+        return cached
+
+    try:
+        context = await zep_breaker.call(zep_client.user.get_context, user_id, min_score=0.5)
+    except Exception as e:
+        print(f"Zep context error: {e!r}")
+        return []
+
+    facts = [f.fact for f in context.facts[:5]] if context and context.facts else []  # Top 5 facts
+    _zep_facts_cache[user_id] = (time.monotonic() + PROFILE_CACHE_TTL, facts)
+    record_source("zep_facts", facts)
+    return facts
+
+
+# ============================================================================
+# PRE-AGENT ENRICHMENT (concurrent, per-step timeouts within a latency budget)
+# ============================================================================
+
+PRE_AGENT_BUDGET = float(os.environ.get("PRE_AGENT_BUDGET_SECONDS", "1.5"))
+ENRICHMENT_TIMEOUTS = {
+    "zep_user": float(os.environ.get("ZEP_USER_TIMEOUT_SECONDS", "1.0")),
+    "zep_context": float(os.environ.get("ZEP_CONTEXT_TIMEOUT_SECONDS", "1.0")),
+    "profile": float(os.environ.get("PROFILE_TIMEOUT_SECONDS", "1.0")),
+}
+
+
+async def run_enrichment(steps: dict, budget: float = PRE_AGENT_BUDGET) -> tuple[dict, dict]:
+    """
+    Run enrichment coroutines concurrently.
+
+    Each step gets its own timeout from ENRICHMENT_TIMEOUTS, capped by whatever is
+    left of the shared budget. A step that times out or fails is skipped so the
+    agent can go ahead without it.
 
     Returns:
-        Dict with total_tax, effective_rate, and breakdown
-    """
-    region = region.lower()
-    buyer_type = buyer_type.lower()
-
-    # Select appropriate bands and surcharge
-    if region == 'england':
-        if buyer_type == 'first-time' and price <= 625000:
-            bands = ENGLAND_FIRST_TIME_BANDS
-            surcharge = 0.0
-        elif buyer_type == 'additional':
-            bands = ENGLAND_STANDARD_BANDS
-            surcharge = ENGLAND_ADDITIONAL_SURCHARGE
-        else:
-            bands = ENGLAND_STANDARD_BANDS
-            surcharge = 0.0
-
-    elif region == 'scotland':
-        if buyer_type == 'first-time':
-            bands = SCOTLAND_FIRST_TIME_BANDS
-            surcharge = 0.0
-        elif buyer_type == 'additional':
-            bands = SCOTLAND_STANDARD_BANDS
-            surcharge = SCOTLAND_ADS
-        else:
-            bands = SCOTLAND_STANDARD_BANDS
-            surcharge = 0.0
+        (results, report) - results maps step name to value for completed steps;
+        report maps step name to {"ms": ..., "status": "ok" | "timeout" | "error"}
+    """
+    deadline = time.monotonic() + budget
+    results = {}
+    report = {}
 
-    elif region == 'wales':
-        # Wales doesn't have first-time buyer relief
-        bands = WALES_STANDARD_BANDS
-        surcharge = WALES_HIGHER_RATES_SURCHARGE if buyer_type == 'additional' else 0.0
+    async def guarded(name: str, coro):
+        started = time.monotonic()
+        timeout = min(ENRICHMENT_TIMEOUTS.get(name, budget), max(0.0, deadline - started))
+        try:
+            results[name] = await asyncio.wait_for(coro, timeout)
+            status = "ok"
+        except asyncio.TimeoutError:
+            status = "timeout"
+        except Exception as e:
+            print(f"[ENRICH] {name} error: {e}", file=sys.stderr)
+            status = "error"
+        report[name] = {"ms": round((time.monotonic() - started) * 1000, 1), "status": status}
 
-    else:
-        return {"error": f"Unknown region: {region}. Use 'england', 'scotland', or 'wales'."}
-
-    # Calculate tax for each band
-    breakdown = []
-    total_tax = 0.0
-    previous_threshold = 0
-
-    for threshold, rate in bands:
-        if price > previous_threshold:
-            taxable_in_band = min(price, threshold) - previous_threshold
-            if taxable_in_band > 0:
-                effective_rate = rate + surcharge
-                tax_in_band = taxable_in_band * effective_rate
-                total_tax += tax_in_band
-
-                breakdown.append({
-                    "band": f"£{previous_threshold:,.0f} - £{threshold:,.0f}" if threshold != float('inf') else f"Above £{previous_threshold:,.0f}",
-                    "rate": f"{effective_rate * 100:.1f}%",
-                    "taxable_amount": taxable_in_band,
-                    "tax_due": tax_in_band
-                })
-
-        previous_threshold = threshold
-        if price <= threshold:
-            break
-
-    effective_rate = (total_tax / price * 100) if price > 0 else 0
+    await asyncio.gather(*(guarded(name, coro) for name, coro in steps.items()))
 
-    return {
-        "purchase_price": price,
-        "region": region.title(),
-        "buyer_type": buyer_type.replace('-', ' ').title(),
-        "total_tax": round(total_tax, 2),
-        "effective_rate": round(effective_rate, 2),
-        "breakdown": breakdown
-    }
+    skipped = [name for name, r in report.items() if r["status"] != "ok"]
+    if skipped:
+        print(f"[ENRICH] Skipped {skipped} (budget {budget}s): {report}", file=sys.stderr)
+    return results, report
 
 
 # ============================================================================
@@ -253,22 +331,138 @@ class AppState(BaseModel):
     current_price: float = 0
     current_region: str = "england"
     current_buyer_type: str = "standard"
-    last_calculation: Optional[dict] = None
+    last_calculation: Optional[CalculationResult] = None
     user: Optional[UserProfile] = None
     zep_context: str = ""
+    preferences: dict = {}
+    recent_calculations: list = []
+    zep_facts: list = []
+    profile_loaded: bool = False
+
+    # True when the state came from an AG-UI frontend, which gets state events from tools
+    _sync_client: bool = PrivateAttr(default=False)
+    # The state the frontend is known to hold, as it sent it (None = it needs a full snapshot)
+    _client_view: Optional[dict] = PrivateAttr(default=None)
+    # Idempotency key of the CLM turn being answered (None for AG-UI)
+    _turn_key: Optional[str] = PrivateAttr(default=None)
+
+    @classmethod
+    def model_validate(cls, obj, **kwargs) -> "AppState":
+        """Validate the state an AG-UI frontend sent, remembering its raw form as the diff baseline."""
+        state = super().model_validate(obj, **kwargs)
+        state._sync_client = True
+        if isinstance(obj, dict) and obj:
+            # Only our fields: keys the frontend keeps for itself must not be patched away
+            state._client_view = {k: v for k, v in obj.items() if k in cls.model_fields}
+        return state
+
+    @field_validator("last_calculation", mode="before")
+    @classmethod
+    def _load_calculation(cls, value):
+        # The frontend echoes back the serialized dict form
+        if isinstance(value, dict):
+            try:
+                return CalculationResult.from_dict(value)
+            except (KeyError, TypeError, ValueError, AttributeError):
+                return None
+        return value
 
+    @field_serializer("last_calculation")
+    def _dump_calculation(self, value: Optional[CalculationResult]):
+        return value.to_dict() if value else None
 
-# Create the agent
+
+def idempotency_key(*parts) -> str:
+    """Stable key for a write, derived from whatever identifies it (session, message, arguments)."""
+    return hashlib.sha256("\x1f".join(str(p) for p in parts).encode()).hexdigest()[:32]
+
+
+def sync_state(ctx: RunContext[StateDeps[AppState]], value):
+    """
+    Attach AG-UI state events for whatever changed since the frontend's last view:
+    a JSON Patch delta normally, a full snapshot only on resync. CLM runs get the bare value.
+    """
+    state = ctx.deps.state
+    if not state._sync_client:
+        return value
+    current = state.model_dump(mode="json")
+    events = state_sync_events(current, state._client_view)
+    if not events:
+        return value
+    state._client_view = current
+    return ToolReturn(return_value=value, metadata=events)
+
+
+def apply_user_context(state: AppState, profile: Optional[dict], facts: Optional[list]):
+    """Copy prefetched profile data and Zep facts into state (either may be skipped)."""
+    if profile is not None:
+        state.preferences = dict(profile["preferences"])
+        state.recent_calculations = profile["calculation_history"][:RECENT_CALCULATIONS_LIMIT]
+    if facts is not None:
+        state.zep_facts = facts
+        if facts and not state.zep_context:
+            state.zep_context = "Known about this user: " + "; ".join(facts)
+    state.profile_loaded = True
+
+
+async def hydrate_user_state(state: AppState):
+    """
+    Prefetch the user's preferences, latest calculations and Zep facts into state
+    so the model can personalise without a get_user_profile/get_zep_memory round trip.
+    """
+    if state.profile_loaded or not state.user or not state.user.id:
+        return
+
+    results, _ = await run_enrichment({
+        "profile": load_user_profile(state.user.id),
+        "zep_context": load_zep_facts(state.user.id),
+    })
+    apply_user_context(state, results.get("profile"), results.get("zep_context"))
+
+
+def format_profile_section(state: AppState) -> str:
+    """Render prefetched profile data as a compact prompt section."""
+    lines = []
+    if state.preferences:
+        prefs = ", ".join(f"{k}={v}" for k, v in state.preferences.items())
+        lines.append(f"- **Preferences**: {prefs}")
+    if state.recent_calculations:
+        calcs = []
+        for calc in state.recent_calculations:
+            metadata = calc.get("metadata") or {}
+            if isinstance(metadata, str):
+                metadata = json.loads(metadata)
+            entry = calc.get("value", "")
+            if metadata.get("stamp_duty") is not None:
+                entry += f" → £{float(metadata['stamp_duty']):,.0f} ({metadata.get('buyer_type', 'standard')})"
+            calcs.append(f"{entry} [{calc.get('date', '')[:10]}]")
+        lines.append(f"- **Recent calculations**: {'; '.join(calcs)}")
+    if not lines:
+        return ""
+    return "\n## SAVED PROFILE\n" + "\n".join(lines) + "\n"
+
+
+def build_model():
+    """Create the Gemini model on the pooled transport, with usage accounting (and recording when trace capture is on)."""
+    provider = GoogleProvider(http_client=http_pools.gemini_http, base_url=GEMINI_BASE_URL)
+    model = GoogleModel(GEMINI_MODEL, provider=provider)
+    if TRACE_CAPTURE_DIR:
+        model = RecordingModel(model)
+    return UsageModel(model)
+
+
+# Create the agent - the model is attached in the lifespan once the HTTP pools are open
 agent = Agent(
-    model=GoogleModel('gemini-2.0-flash'),
+    model=None,
     deps_type=StateDeps[AppState]
 )
 
 
-@agent.system_prompt
+@agent.instructions
 async def dynamic_system_prompt(ctx: RunContext[StateDeps[AppState]]) -> str:
-    """Build system prompt with user context."""
+    """Build the prompt with user context (instructions, so it also runs when there is message history)."""
     state = ctx.deps.state
+    await hydrate_user_state(state)
 
     # Build user context section
     user_section = ""
@@ -289,45 +483,42 @@ When greeting or addressing the user, use their name: {state.user.name}
 Use this context to personalize your responses.
 """
 
+    profile_section = format_profile_section(state)
+
     return f"""You are an expert UK stamp duty assistant. Help users understand their stamp duty obligations when buying property in the UK.
 {user_section}
+{profile_section}
 {memory_section}
 
 ## KEY KNOWLEDGE
-- **England & Northern Ireland**: SDLT (Stamp Duty Land Tax)
-  - Standard: 0% up to £250k, 5% to £925k, 10% to £1.5M, 12% above
-  - First-time buyers: 0% up to £425k, 5% to £625k (only if total price ≤ £625k)
-  - Additional properties: +5% surcharge on all bands
-
-- **Scotland**: LBTT (Land and Buildings Transaction Tax)
-  - Standard: 0% to £145k, 2% to £250k, 5% to £325k, 10% to £750k, 12% above
-  - First-time buyers: 0% to £175k, then standard rates
-  - Additional properties: +6% ADS (Additional Dwelling Supplement)
-
-- **Wales**: LTT (Land Transaction Tax)
-  - Standard: 0% to £225k, 6% to £400k, 7.5% to £750k, 10% to £1.5M, 12% above
-  - NO first-time buyer relief in Wales
-  - Additional properties: +4% surcharge
+- **England & NI (SDLT)**: 0% to £250k, 5% to £925k, 10% to £1.5M, 12% above. First-time buyers: 0% to £425k, 5% to £625k, only if the price is £625k or less. Additional properties: +5% on every band.
+- **Scotland (LBTT)**: 0% to £145k, 2% to £250k, 5% to £325k, 10% to £750k, 12% above. First-time buyers: 0% to £175k. Additional dwellings: +6% ADS.
+- **Wales (LTT)**: 0% to £225k, 6% to £400k, 7.5% to £750k, 10% to £1.5M, 12% above. No first-time buyer relief. Additional properties: +4%.
+- Rules for less common cases (non-resident, company, mixed-use, refunds...) are under RELEVANT KNOWLEDGE when they apply.
+- Always use calculate_stamp_duty_tool for amounts rather than doing the maths yourself.
 
 ## TOOLS AVAILABLE
 
 ### Calculation Tools
 - `calculate_stamp_duty_tool`: Calculate stamp duty for a specific scenario
+- `calculate_and_save`: Calculate and save to the user's history in one step
 - `compare_buyer_types`: Compare costs across different buyer types
 
 ### User Profile & Memory Tools
 - `get_user_profile`: Get user's saved preferences and calculation history
 - `save_user_preference`: Save user preferences (region, buyer_type, price_range)
-- `save_calculation`: Save a calculation to user's history
+- `save_last_calculation`: Save the calculation just made (no arguments)
 - `get_zep_memory`: Get what you remember about the user from past conversations
 
 ## BEHAVIOR
 
 ### When calculating:
 1. When user mentions a price/location, use calculate_stamp_duty_tool immediately
-2. Always explain the breakdown clearly
-3. Offer to compare scenarios
-4. After calculating, offer to save it: "Want me to save this calculation?"
+2. If a logged-in user already asked for it to be saved, use calculate_and_save instead - one call, no separate save
+3. Always explain the breakdown clearly
+4. Offer to compare scenarios
+5. After calculating, offer to save it: "Want me to save this calculation?"
+6. If they say yes, call save_last_calculation() - never re-send the price or amount
 
 ### When user shares preferences:
 - "I'm a first-time buyer" → save_user_preference("buyer_type", "first-time")
@@ -335,9 +526,10 @@ Use this context to personalize your responses.
 - "My budget is around 500k" → save_user_preference("price_range", "500000")
 
 ### When user asks about their profile:
-- "What do you know about me?" → get_user_profile()
-- "What do you remember?" → get_zep_memory()
-- "My past calculations" → get_user_profile() and show calculation_history
+- SAVED PROFILE and MEMORY above are already loaded - answer from them directly, no tool call needed
+- "What do you know about me?" → summarise SAVED PROFILE and MEMORY
+- Only call get_user_profile() for calculation history older than the recent ones shown
+- Only call get_zep_memory() if the user asks for more than the memory shown
 
 ### Important:
 - Be concise but accurate
@@ -347,13 +539,50 @@ Use this context to personalize your responses.
 """
 
 
+def latest_user_text(ctx: RunContext[StateDeps[AppState]]) -> str:
+    """Return the text of the current user message (CLM passes a prompt, AG-UI only history)."""
+    if isinstance(ctx.prompt, str):
+        return ctx.prompt
+    for message in reversed(ctx.messages):
+        if isinstance(message, ModelRequest):
+            for part in message.parts:
+                if isinstance(part, UserPromptPart) and isinstance(part.content, str):
+                    return part.content
+    return ""
+
+
+def recent_user_text(ctx: RunContext[StateDeps[AppState]], turns: int = 2) -> str:
+    """Join the current user message with the ones before it (a follow-up like 'what about Scotland?' says little alone)."""
+    texts = []
+    for message in reversed(ctx.messages):
+        if isinstance(message, ModelRequest):
+            texts.extend(
+                part.content for part in message.parts
+                if isinstance(part, UserPromptPart) and isinstance(part.content, str)
+            )
+    # CLM passes the current message as the prompt, which may not be in the history yet
+    if isinstance(ctx.prompt, str) and (not texts or texts[0] != ctx.prompt):
+        texts.insert(0, ctx.prompt)
+    return " ".join(texts[:turns])
+
+
+@agent.instructions
+async def relevant_knowledge(ctx: RunContext[StateDeps[AppState]]) -> str:
+    """Inject the top-k knowledge snippets for the current question (re-evaluated every run)."""
+    snippets = knowledge_index.search(recent_user_text(ctx), KNOWLEDGE_TOP_K)
+    if not snippets:
+        return ""
+    lines = [f"- **{snippet.title}**: {snippet.text}" for snippet in snippets]
+    return "## RELEVANT KNOWLEDGE\n" + "\n".join(lines)
+
+
 @agent.tool
 async def calculate_stamp_duty_tool(
     ctx: RunContext[StateDeps[AppState]],
     purchase_price: float,
     region: str,
     buyer_type: str
-) -> dict:
+) -> dict | ToolReturn:
     """
     Calculate UK stamp duty for a property purchase.
 
@@ -365,15 +594,22 @@ async def calculate_stamp_duty_tool(
     Returns:
         Calculation result with total tax, effective rate, and breakdown
     """
-    result = calculate_stamp_duty(purchase_price, region, buyer_type)
+    try:
+        result = calculate_stamp_duty(purchase_price, region, buyer_type)
+    except ValueError as e:
+        return {"error": str(e)}
 
-    # Update state
-    ctx.deps.state.current_price = purchase_price
-    ctx.deps.state.current_region = region
-    ctx.deps.state.current_buyer_type = buyer_type
-    ctx.deps.state.last_calculation = result
+    remember_calculation(ctx, result, region, buyer_type)
+    return sync_state(ctx, result.to_dict())
 
-    return result
+
+def remember_calculation(ctx: RunContext[StateDeps[AppState]], result: CalculationResult, region: str, buyer_type: str):
+    """Make a calculation the current one in shared state (what save_last_calculation persists)."""
+    state = ctx.deps.state
+    state.current_price = result.purchase_price
+    state.current_region = region
+    state.current_buyer_type = buyer_type
+    state.last_calculation = result
 
 
 @agent.tool
@@ -396,11 +632,14 @@ async def compare_buyer_types(
     comparisons = []
 
     for bt in buyer_types:
-        result = calculate_stamp_duty(purchase_price, region, bt)
+        try:
+            result = calculate_stamp_duty(purchase_price, region, bt)
+        except ValueError as e:
+            return {"error": str(e)}
         comparisons.append({
             "buyer_type": bt.replace('-', ' ').title(),
-            "total_tax": result["total_tax"],
-            "effective_rate": result["effective_rate"]
+            "total_tax": result.total_tax,
+            "effective_rate": result.effective_rate
         })
 
     # Calculate savings
@@ -420,11 +659,14 @@ async def compare_buyer_types(
 # USER PROFILE & MEMORY TOOLS
 # ============================================================================
 
+SAVING_UNAVAILABLE = "Saving is temporarily unavailable - carry on without saving."
+
 @agent.tool
 async def get_user_profile(ctx: RunContext[StateDeps[AppState]]) -> dict:
     """
     Get the current user's profile information from Neon database and Zep memory.
-    Call this when user asks 'what do you know about me', 'my profile', 'my preferences', etc.
+    Preferences and recent calculations are already in SAVED PROFILE - only call this
+    when the user wants their full calculation history.
 
     Returns their name, saved preferences (region, buyer type), and any Zep memory facts.
     """
@@ -443,45 +685,14 @@ async def get_user_profile(ctx: RunContext[StateDeps[AppState]]) -> dict:
         "zep_facts": []
     }
 
-    # Fetch from Neon database
-    if DATABASE_URL:
-        try:
-            conn = psycopg2.connect(DATABASE_URL)
-            cur = conn.cursor()
-
-            # Get user preferences
-            cur.execute("""
-                SELECT item_type, value, metadata, created_at
-                FROM user_profile_items
-                WHERE user_id = %s
-                ORDER BY created_at DESC
-            """, (user.id,))
-            items = cur.fetchall()
-
-            for item_type, value, metadata, created_at in items:
-                if item_type in ['preferred_region', 'buyer_type', 'price_range']:
-                    profile["preferences"][item_type] = value
-                elif item_type == 'calculation':
-                    profile["calculation_history"].append({
-                        "value": value,
-                        "metadata": metadata,
-                        "date": str(created_at)
-                    })
-
-            cur.close()
-            conn.close()
-            print(f"[TOOL] get_user_profile: Found {len(items)} items for user {user.id[:8]}...", file=sys.stderr)
-        except Exception as e:
-            print(f"[TOOL] get_user_profile DB error: {e}", file=sys.stderr)
-
-    # Fetch Zep memory facts
-    if zep_client and user.id:
-        try:
-            context = zep_client.user.get_context(user.id, min_score=0.5)
-            if context and context.facts:
-                profile["zep_facts"] = [f.fact for f in context.facts[:5]]
-        except Exception as e:
-            print(f"[TOOL] get_user_profile Zep error: {e}", file=sys.stderr)
+    stored, facts = await asyncio.gather(
+        load_user_profile(user.id),
+        load_zep_facts(user.id),
+    )
+    profile["preferences"] = dict(stored["preferences"])
+    profile["calculation_history"] = stored["calculation_history"]
+    profile["zep_facts"] = facts
+    print(f"[TOOL] get_user_profile: {len(profile['calculation_history'])} calculations for user {user.id[:8]}...", file=sys.stderr)
 
     return profile
 
@@ -491,7 +702,7 @@ async def save_user_preference(
     ctx: RunContext[StateDeps[AppState]],
     preference_type: str,
     value: str
-) -> dict:
+) -> dict | ToolReturn:
     """
     Save a user preference to their profile in Neon database.
 
@@ -538,13 +749,33 @@ async def save_user_preference(
 
     elif preference_type == "price_range":
         # Extract number from price
-        import re
         numbers = re.findall(r'[\d,]+', normalized_value.replace('£', ''))
         if numbers:
             normalized_value = numbers[0].replace(',', '')
 
     try:
-        conn = psycopg2.connect(DATABASE_URL)
+        old_value = await neon_breaker.call(_replace_preference, user.id, preference_type, normalized_value)
+
+        invalidate_user_cache(user.id)
+        state.preferences[preference_type] = normalized_value
+
+        print(f"[TOOL] save_user_preference: {preference_type}={normalized_value} for user {user.id[:8]}...", file=sys.stderr)
+
+        if old_value:
+            return sync_state(ctx, {"saved": True, "preference": preference_type, "value": normalized_value, "replaced": old_value})
+        return sync_state(ctx, {"saved": True, "preference": preference_type, "value": normalized_value})
+
+    except CircuitOpenError:
+        return {"saved": False, "message": SAVING_UNAVAILABLE}
+    except Exception as e:
+        print(f"[TOOL] save_user_preference error: {e!r}", file=sys.stderr)
+        return {"saved": False, "error": str(e) or type(e).__name__}
+
+
+def _replace_preference(user_id: str, preference_type: str, value: str) -> Optional[str]:
+    """Replace a single-value preference; returns the value it replaced, if any."""
+    conn = db_connect()
+    try:
         cur = conn.cursor()
 
         # Check for existing preference of same type
@@ -552,7 +783,7 @@ async def save_user_preference(
             SELECT id, value FROM user_profile_items
             WHERE user_id = %s AND item_type = %s
             LIMIT 1
-        """, (user.id, preference_type))
+        """, (user_id, preference_type))
         existing = cur.fetchone()
 
         old_value = None
@@ -562,7 +793,7 @@ async def save_user_preference(
             cur.execute("""
                 DELETE FROM user_profile_items
                 WHERE user_id = %s AND item_type = %s
-            """, (user.id, preference_type))
+            """, (user_id, preference_type))
 
         # Insert new value
         cur.execute("""
@@ -570,22 +801,14 @@ async def save_user_preference(
             VALUES (%s, %s, %s, %s, %s)
             ON CONFLICT (user_id, item_type, value) DO UPDATE SET updated_at = NOW()
             RETURNING id
-        """, (user.id, preference_type, normalized_value, '{"source": "voice"}', True))
+        """, (user_id, preference_type, value, '{"source": "voice"}', True))
 
         conn.commit()
         cur.close()
+        return old_value
+    finally:
         conn.close()
 
-        print(f"[TOOL] save_user_preference: {preference_type}={normalized_value} for user {user.id[:8]}...", file=sys.stderr)
-
-        if old_value:
-            return {"saved": True, "preference": preference_type, "value": normalized_value, "replaced": old_value}
-        return {"saved": True, "preference": preference_type, "value": normalized_value}
-
-    except Exception as e:
-        print(f"[TOOL] save_user_preference error: {e}", file=sys.stderr)
-        return {"saved": False, "error": str(e)}
-
 
 @agent.tool
 async def save_calculation(
@@ -596,8 +819,9 @@ async def save_calculation(
     stamp_duty: float
 ) -> dict:
     """
-    Save a stamp duty calculation to the user's history.
-    Call this AFTER calculating stamp duty to save it for the user.
+    Save a stamp duty calculation given in full to the user's history.
+    Prefer save_last_calculation (no arguments) for the calculation just made;
+    use this only for a scenario that was not calculated in this conversation.
 
     Args:
         price: Property price
@@ -618,9 +842,6 @@ async def save_calculation(
         return {"saved": False, "message": "Database not configured"}
 
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-
         metadata = json.dumps({
             "price": price,
             "region": region,
@@ -628,29 +849,159 @@ async def save_calculation(
             "stamp_duty": stamp_duty,
             "source": "voice"
         })
+        # A retried turn saves under the same key, which the unique index turns into a no-op
+        key = idempotency_key(turn_key_for(ctx), price, region.lower(), buyer_type.lower())
+        inserted = await neon_breaker.call(_insert_calculation, user.id, f"£{price:,.0f} in {region.title()}", metadata, key)
 
-        cur.execute("""
-            INSERT INTO user_profile_items (user_id, item_type, value, metadata, confirmed)
-            VALUES (%s, 'calculation', %s, %s, TRUE)
-        """, (user.id, f"£{price:,.0f} in {region.title()}", metadata))
+        invalidate_user_cache(user.id)
+
+        print(f"[TOOL] save_calculation: £{price:,.0f} {region} for user {user.id[:8]}... (duplicate={not inserted})", file=sys.stderr)
+        return {"saved": True, "already_saved": not inserted, "calculation": f"£{price:,.0f} property in {region.title()}"}
+
+    except CircuitOpenError:
+        return {"saved": False, "message": SAVING_UNAVAILABLE}
+    except Exception as e:
+        print(f"[TOOL] save_calculation error: {e!r}", file=sys.stderr)
+        return {"saved": False, "error": str(e) or type(e).__name__}
 
+
+def turn_key_for(ctx: RunContext[StateDeps[AppState]]) -> str:
+    """The current turn's idempotency key (CLM sets one; AG-UI falls back to user + message)."""
+    state = ctx.deps.state
+    return state._turn_key or idempotency_key(state.user.id, latest_user_text(ctx))
+
+
+async def record_calculation(user_id: str, result: CalculationResult, turn_key: str) -> bool:
+    """Persist a calculation result (idempotent per turn); returns False if it was already saved."""
+    metadata = json.dumps({
+        "price": result.purchase_price,
+        "region": result.region,
+        "buyer_type": result.buyer_type,
+        "stamp_duty": result.total_tax,
+        "source": "voice"
+    })
+    key = idempotency_key(turn_key, result.purchase_price, result.region, result.buyer_type)
+    value = f"£{result.purchase_price:,.0f} in {result.region.title()}"
+    inserted = await neon_breaker.call(_insert_calculation, user_id, value, metadata, key)
+    invalidate_user_cache(user_id)
+    return inserted
+
+
+def _insert_calculation(user_id: str, value: str, metadata: str, key: str) -> bool:
+    """Insert a calculation row; returns False if it is already in the user's history."""
+    conn = db_connect()
+    try:
+        cur = conn.cursor()
+        try:
+            cur.execute("""
+                INSERT INTO user_profile_items (user_id, item_type, value, metadata, confirmed, idempotency_key)
+                VALUES (%s, 'calculation', %s, %s, TRUE, %s)
+                ON CONFLICT (user_id, idempotency_key) WHERE idempotency_key IS NOT NULL DO NOTHING
+            """, (user_id, value, metadata, key))
+        except psycopg2.errors.UniqueViolation:
+            # Same calculation saved on an earlier turn (the (user_id, item_type, value) index)
+            conn.rollback()
+            return False
+        inserted = cur.rowcount > 0
         conn.commit()
         cur.close()
+        return inserted
+    finally:
         conn.close()
 
-        print(f"[TOOL] save_calculation: £{price:,.0f} {region} for user {user.id[:8]}...", file=sys.stderr)
-        return {"saved": True, "calculation": f"£{price:,.0f} property in {region.title()}"}
 
+@agent.tool
+async def calculate_and_save(
+    ctx: RunContext[StateDeps[AppState]],
+    purchase_price: float,
+    region: str,
+    buyer_type: str
+) -> dict | ToolReturn:
+    """
+    Calculate UK stamp duty AND save it to the user's history in one step.
+    Use this instead of calculate_stamp_duty_tool when a logged-in user wants the result saved.
+
+    Args:
+        purchase_price: Property price in GBP (pounds)
+        region: 'england' (includes NI), 'scotland', or 'wales'
+        buyer_type: 'standard', 'first-time', or 'additional'
+
+    Returns:
+        Calculation result plus whether it was saved
+    """
+    try:
+        result = calculate_stamp_duty(purchase_price, region, buyer_type)
+    except ValueError as e:
+        return {"error": str(e)}
+
+    remember_calculation(ctx, result, region, buyer_type)
+    response = result.to_dict()
+
+    user = ctx.deps.state.user
+    if not user or not user.id:
+        response.update(saved=False, message="User not logged in. Sign in to save calculations.")
+    elif not DATABASE_URL:
+        response.update(saved=False, message="Database not configured")
+    else:
+        # One write behind the breaker: wait for it so "saved" is only claimed once it is true
+        try:
+            inserted = await record_calculation(user.id, result, turn_key_for(ctx))
+            response.update(saved=True, already_saved=not inserted)
+            print(f"[TOOL] calculate_and_save: £{result.purchase_price:,.0f} {result.region} for user {user.id[:8]}... (duplicate={not inserted})", file=sys.stderr)
+        except CircuitOpenError:
+            response.update(saved=False, message=SAVING_UNAVAILABLE)
+        except Exception as e:
+            print(f"[TOOL] calculate_and_save error: {e!r}", file=sys.stderr)
+            response.update(saved=False, error=str(e) or type(e).__name__)
+
+    return sync_state(ctx, response)
+
+
+@agent.tool
+async def save_last_calculation(ctx: RunContext[StateDeps[AppState]]) -> dict:
+    """
+    Save the calculation just made to the user's history. Takes no arguments -
+    the amounts come from the last calculation, so never re-send them.
+    Use this when the user says yes to saving.
+
+    Returns:
+        Confirmation of saved calculation
+    """
+    state = ctx.deps.state
+    user = state.user
+    result = state.last_calculation
+
+    if not user or not user.id:
+        return {"saved": False, "message": "User not logged in"}
+
+    if not DATABASE_URL:
+        return {"saved": False, "message": "Database not configured"}
+
+    if result is None:
+        return {"saved": False, "message": "No calculation to save yet - calculate first."}
+
+    try:
+        inserted = await record_calculation(user.id, result, turn_key_for(ctx))
+    except CircuitOpenError:
+        return {"saved": False, "message": SAVING_UNAVAILABLE}
     except Exception as e:
-        print(f"[TOOL] save_calculation error: {e}", file=sys.stderr)
-        return {"saved": False, "error": str(e)}
+        print(f"[TOOL] save_last_calculation error: {e!r}", file=sys.stderr)
+        return {"saved": False, "error": str(e) or type(e).__name__}
+
+    print(f"[TOOL] save_last_calculation: £{result.purchase_price:,.0f} {result.region} for user {user.id[:8]}... (duplicate={not inserted})", file=sys.stderr)
+    return {
+        "saved": True,
+        "already_saved": not inserted,
+        "calculation": f"£{result.purchase_price:,.0f} property in {result.region.title()}",
+        "stamp_duty": result.total_tax
+    }
 
 
 @agent.tool
 async def get_zep_memory(ctx: RunContext[StateDeps[AppState]]) -> dict:
     """
     Get what the AI remembers about the user from Zep knowledge graph.
-    Call this when user asks 'what do you remember', 'what do you know about me'.
+    Top facts are already in MEMORY - only call this when the user asks for more detail.
 
     Returns facts extracted from past conversations.
     """
@@ -664,7 +1015,7 @@ async def get_zep_memory(ctx: RunContext[StateDeps[AppState]]) -> dict:
         return {"has_memory": False, "message": "Memory not configured."}
 
     try:
-        context = zep_client.user.get_context(user.id, min_score=0.3)
+        context = await zep_breaker.call(zep_client.user.get_context, user.id, min_score=0.3)
         if context and context.facts:
             facts = [{"fact": f.fact, "score": f.score} for f in context.facts[:10]]
             return {
@@ -674,17 +1025,58 @@ async def get_zep_memory(ctx: RunContext[StateDeps[AppState]]) -> dict:
                 "facts": facts
             }
         return {"has_memory": True, "facts_count": 0, "message": "No memories yet. Keep chatting!"}
+    except CircuitOpenError:
+        return {"has_memory": False, "message": "Memory is temporarily unavailable."}
     except Exception as e:
-        print(f"[TOOL] get_zep_memory error: {e}", file=sys.stderr)
-        return {"has_memory": False, "error": str(e)}
+        print(f"[TOOL] get_zep_memory error: {e!r}", file=sys.stderr)
+        return {"has_memory": False, "error": str(e) or type(e).__name__}
 
 
 # ============================================================================
 # FASTAPI APP WITH AG-UI AND CLM ENDPOINTS
 # ============================================================================
 
+async def refresh_knowledge_loop():
+    """Incrementally re-sync the knowledge index on an interval."""
+    while True:
+        try:
+            stats = await asyncio.to_thread(
+                knowledge_index.refresh, KNOWLEDGE_DIR, DATABASE_URL, NEON_CONNECT_TIMEOUT
+            )
+            if stats["updated"] or stats["removed"]:
+                print(f"[KNOWLEDGE] Refreshed: {stats}", file=sys.stderr)
+        except Exception as e:
+            print(f"[KNOWLEDGE] Refresh error: {e}", file=sys.stderr)
+        await asyncio.sleep(KNOWLEDGE_REFRESH_SECONDS)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Open the provider HTTP pools and clients, build the knowledge index, start the job workers; tear down on exit."""
+    global zep_client
+
+    http_pools.open()
+    agent.model = build_model()
+    zep_client = build_zep_client()
+
+    # Build from the content directory synchronously so the first request has snippets
+    knowledge_index.refresh(KNOWLEDGE_DIR)
+    refresh_task = asyncio.create_task(refresh_knowledge_loop())
+    # Bulk calculation workers; unfinished jobs resume from their last checkpoint
+    job_manager.start()
+    try:
+        yield
+    finally:
+        refresh_task.cancel()
+        await job_manager.stop()
+        zep_breaker.shutdown()
+        neon_breaker.shutdown()
+        zep_client = None
+        await http_pools.aclose()
+
+
 # Create main FastAPI app
-main_app = FastAPI(title="Stamp Duty Calculator Agent")
+main_app = FastAPI(title="Stamp Duty Calculator Agent", lifespan=lifespan)
 
 # Add CORS middleware
 main_app.add_middleware(
@@ -695,6 +1087,17 @@ main_app.add_middleware(
     allow_headers=["*"],
 )
 
+# Per-request model usage accounting (inside trace capture so traces include it)
+main_app.add_middleware(UsageMiddleware)
+
+# Opt-in session trace capture for offline replay (see replay.py)
+if TRACE_CAPTURE_DIR:
+    main_app.add_middleware(TraceCaptureMiddleware)
+
+# Opt-in request profiling (no middleware at all unless PROFILE_ENABLED)
+if PROFILE_ENABLED:
+    main_app.add_middleware(ProfilingMiddleware)
+
 # Create AG-UI app from agent
 ag_ui_app = agent.to_ag_ui(deps=StateDeps(AppState()))
 
@@ -708,8 +1111,10 @@ async def health():
     return {
         "status": "ok",
         "service": "stamp-duty-calculator-agent",
-        "endpoints": ["/agui/", "/chat/completions", "/user", "/debug"],
-        "zep_enabled": zep_client is not None
+        "endpoints": ["/agui/", "/chat/completions", "/user", "/debug", "/debug/profiles", "/metrics/usage", "/jobs"],
+        "zep_enabled": zep_client is not None,
+        "knowledge_snippets": len(knowledge_index),
+        "breakers": {b.name: b.snapshot() for b in (zep_breaker, neon_breaker)}
     }
 
 
@@ -720,26 +1125,96 @@ async def debug_endpoint():
     return _last_clm_request
 
 
+@main_app.get("/metrics/usage")
+async def usage_metrics():
+    """Model requests, tokens, tool calls and model time per endpoint, tier and tool, plus budget alarms."""
+    return usage_ledger.snapshot()
+
+
+@main_app.get("/debug/profiles")
+async def list_profiles():
+    """List captured request profiles, newest first."""
+    return {"enabled": PROFILE_ENABLED, "profiles": profile_store.list()}
+
+
+@main_app.get("/debug/profiles/{filename}")
+async def download_profile(filename: str):
+    """Download a .collapsed or .speedscope.json profile file."""
+    path = profile_store.path(filename)
+    if not path:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path)
+
+
+# Bulk calculation jobs (see jobs.py)
+@main_app.post("/jobs", status_code=202)
+async def create_job(request: Request):
+    """
+    Queue a portfolio CSV (raw request body) for bulk calculation.
+    Columns: price or purchase_price, plus optional region and buyer_type.
+    """
+    try:
+        job_id = await job_manager.submit(request.stream(), filename=request.headers.get("x-filename"))
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return {"job_id": job_id, "status_url": f"/jobs/{job_id}", "results_url": f"/jobs/{job_id}/results"}
+
+
+@main_app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await asyncio.to_thread(job_store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    job["results_url"] = f"/jobs/{job_id}/results"
+    return job
+
+
+@main_app.get("/jobs/{job_id}/results")
+async def download_job_results(job_id: str):
+    """Results CSV of every chunk finished so far (complete once status is 'completed')."""
+    job = await asyncio.to_thread(job_store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return StreamingResponse(
+        job_manager.result_rows(job_id),
+        media_type="text/csv",
+        headers={
+            "Content-Disposition": f'attachment; filename="stamp-duty-{job_id}.csv"',
+            "X-Job-Status": job["status"],
+            "X-Job-Progress": str(job["progress"]),
+        },
+    )
+
+
+def parse_body(model: type[BaseModel], raw: bytes):
+    """Parse and validate a JSON body in one pass (pydantic-core), or fail with a 422."""
+    try:
+        return model.model_validate_json(raw)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False, include_context=False, include_input=False))
+
+
+class UserRegistration(BaseModel):
+    """Body of POST /user."""
+    user_id: str = Field(min_length=1)
+    email: Optional[str] = None
+    name: Optional[str] = None
+
+
 # User registration endpoint for frontend
 @main_app.post("/user")
 async def register_user(request: Request):
     """Register or update a user in Zep for memory tracking."""
+    body = parse_body(UserRegistration, await request.body())
+
     if not zep_client:
         return {"status": "zep_not_configured"}
 
     try:
-        body = await request.json()
-        user_id = body.get("user_id")
-        email = body.get("email")
-        name = body.get("name")
-
-        if not user_id:
-            return {"error": "user_id required"}, 400
-
-        user = await get_or_create_zep_user(user_id, email, name)
+        user = await get_or_create_zep_user(body.user_id, body.email, body.name)
         return {
             "status": "ok",
-            "user_id": user_id,
+            "user_id": body.user_id,
             "zep_user": user is not None
         }
     except Exception as e:
@@ -750,16 +1225,50 @@ async def register_user(request: Request):
 # CLM ENDPOINT FOR HUME VOICE
 # ============================================================================
 
-def extract_session_id(request: Request, body: dict) -> Optional[str]:
+class ChatMessage(BaseModel):
+    """One OpenAI-style chat message as sent by Hume."""
+    model_config = ConfigDict(extra="allow")
+
+    role: str = "user"
+    content: Union[str, list, None] = None
+
+    @property
+    def text(self) -> str:
+        """Message text (joins text parts when content is a list)."""
+        if isinstance(self.content, str):
+            return self.content
+        if isinstance(self.content, list):
+            return " ".join(part.get("text", "") for part in self.content if isinstance(part, dict))
+        return ""
+
+
+class ClmMetadata(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    custom_session_id: Optional[str] = None
+    session_id: Optional[str] = None
+
+
+class ClmRequest(BaseModel):
+    """Body of POST /chat/completions (other OpenAI fields are kept as extras)."""
+    model_config = ConfigDict(extra="allow")
+
+    messages: list[ChatMessage] = []
+    custom_session_id: Optional[str] = None
+    customSessionId: Optional[str] = None
+    session_id: Optional[str] = None
+    metadata: ClmMetadata = ClmMetadata()
+
+
+def extract_session_id(request: Request, body: ClmRequest) -> Optional[str]:
     """Extract session ID from various sources (Hume sends it in body)."""
     # Check body first (Hume's primary method)
-    session_id = body.get("custom_session_id") or body.get("customSessionId") or body.get("session_id")
+    session_id = body.custom_session_id or body.customSessionId or body.session_id
     if session_id:
         return session_id
 
     # Check metadata
-    metadata = body.get("metadata", {})
-    session_id = metadata.get("custom_session_id") or metadata.get("session_id")
+    session_id = body.metadata.custom_session_id or body.metadata.session_id
     if session_id:
         return session_id
 
@@ -791,7 +1300,11 @@ def parse_session_id(session_id: Optional[str]) -> dict:
     return {"user_name": user_name, "user_id": user_id}
 
 
-def extract_user_from_messages(messages: list) -> dict:
+NAME_PATTERN = re.compile(r'\b(?:first_name|name):\s*(\w+)', re.IGNORECASE)
+USER_ID_PATTERN = re.compile(r'\b(?:user_id|id):\s*([^\s,\n]+)', re.IGNORECASE)
+
+
+def extract_user_from_messages(messages: list[ChatMessage]) -> dict:
     """
     Extract user name and id from system messages.
     Hume may forward sessionSettings.variables as system message content.
@@ -799,32 +1312,115 @@ def extract_user_from_messages(messages: list) -> dict:
     - "first_name: Dan" or "name: Dan"
     - "user_id: abc123"
     """
-    import re
     user_name = ""
     user_id = ""
 
     for msg in messages:
-        if msg.get("role") == "system":
-            content = msg.get("content", "")
-            if isinstance(content, str):
-                # Look for first_name or name
-                match = re.search(r'\b(?:first_name|name):\s*(\w+)', content, re.IGNORECASE)
-                if match and match.group(1).lower() not in ['unknown', 'none', '']:
-                    user_name = match.group(1)
-                    print(f"[CLM] Found name in system message: {user_name}", file=sys.stderr)
-
-                # Look for user_id or id (various formats)
-                match = re.search(r'\b(?:user_id|id):\s*([^\s,\n]+)', content, re.IGNORECASE)
-                if match and match.group(1).lower() not in ['unknown', 'none', 'anonymous', '']:
-                    user_id = match.group(1)
-                    print(f"[CLM] Found user_id in system message: {user_id}", file=sys.stderr)
+        if msg.role == "system" and isinstance(msg.content, str):
+            # Look for first_name or name
+            match = NAME_PATTERN.search(msg.content)
+            if match and match.group(1).lower() not in ['unknown', 'none', '']:
+                user_name = match.group(1)
+                print(f"[CLM] Found name in system message: {user_name}", file=sys.stderr)
+
+            # Look for user_id or id (various formats)
+            match = USER_ID_PATTERN.search(msg.content)
+            if match and match.group(1).lower() not in ['unknown', 'none', 'anonymous', '']:
+                user_id = match.group(1)
+                print(f"[CLM] Found user_id in system message: {user_id}", file=sys.stderr)
 
     return {"user_name": user_name, "user_id": user_id}
 
 
+# session_id -> (user_name, user_id), for sessions whose user id has been resolved
+IDENTITY_CACHE_SIZE = int(os.environ.get("IDENTITY_CACHE_SIZE", "10000"))
+_identity_cache: OrderedDict[str, tuple[str, str]] = OrderedDict()
+
+
+def resolve_identity(request: Request, body: ClmRequest) -> tuple[str, str]:
+    """
+    Resolve (user_name, user_id) from the session ID, falling back to system messages.
+    Resolved identities are cached per session so later turns skip the scan.
+    """
+    session_id = extract_session_id(request, body)
+    if session_id and session_id in _identity_cache:
+        _identity_cache.move_to_end(session_id)
+        return _identity_cache[session_id]
+
+    # Session ID format: "userName|userId"
+    parsed = parse_session_id(session_id)
+    user_name = parsed["user_name"]
+    user_id = parsed["user_id"]
+
+    # Fallback: extract from system messages
+    if not user_name or not user_id:
+        msg_parsed = extract_user_from_messages(body.messages)
+        if not user_name and msg_parsed["user_name"]:
+            user_name = msg_parsed["user_name"]
+        if not user_id and msg_parsed["user_id"]:
+            user_id = msg_parsed["user_id"]
+
+    if session_id and user_id:
+        _identity_cache[session_id] = (user_name, user_id)
+        if len(_identity_cache) > IDENTITY_CACHE_SIZE:
+            _identity_cache.popitem(last=False)
+
+    return user_name, user_id
+
+
+# Hume retries a turn on timeout. Each turn's response is kept briefly under its
+# idempotency key so a retry replays it (or waits for the in-flight original)
+# instead of re-running the agent, its saves and the Zep write.
+TURN_CACHE_TTL = float(os.environ.get("TURN_CACHE_TTL_SECONDS", "120"))
+TURN_CACHE_SIZE = 1000
+
+# turn key -> (expires_at, future resolving to the response text)
+_turn_responses: dict[str, tuple[float, asyncio.Future]] = {}
+
+# CLM rebuilds state every turn, so each session's last calculation is kept here
+# for save_last_calculation on a later turn (AG-UI carries it in the shared state)
+_session_calculations: OrderedDict[str, CalculationResult] = OrderedDict()
+
+
+def turn_idempotency_key(session_id: Optional[str], user_id: str, messages: list[ChatMessage], user_msg: str) -> Optional[str]:
+    """Key for one CLM turn: the session (or user), the turn number and the user's message."""
+    owner = session_id or user_id
+    if not owner:
+        return None
+    turn = sum(1 for m in messages if m.role == "user")
+    return idempotency_key(owner, turn, user_msg)
+
+
+def begin_turn(key: str) -> tuple[asyncio.Future, bool]:
+    """Return (future, is_new). A new future must be resolved by the caller."""
+    cached = _cache_get(_turn_responses, key)
+    if cached is not None:
+        return cached, False
+    if len(_turn_responses) >= TURN_CACHE_SIZE:
+        now = time.monotonic()
+        for stale in [k for k, (expires, _) in _turn_responses.items() if expires <= now]:
+            del _turn_responses[stale]
+        if len(_turn_responses) >= TURN_CACHE_SIZE:
+            del _turn_responses[next(iter(_turn_responses))]
+    future = asyncio.get_running_loop().create_future()
+    _turn_responses[key] = (time.monotonic() + TURN_CACHE_TTL, future)
+    return future, True
+
+
+def abandon_turn(key: str, future: asyncio.Future, response: Optional[str] = None):
+    """
+    Drop a turn from the cache (only if it is still this attempt's) and wake any waiting
+    retries with `response` - None tells them to run the turn themselves.
+    """
+    cached = _turn_responses.get(key)
+    if cached is not None and cached[1] is future:
+        del _turn_responses[key]
+    if not future.done():
+        future.set_result(response)
+
+
 async def stream_sse_response(content: str, msg_id: str):
     """Stream OpenAI-compatible SSE chunks for Hume."""
-    import asyncio
     words = content.split(' ')
     for i, word in enumerate(words):
         chunk = {
@@ -844,13 +1440,13 @@ async def stream_sse_response(content: str, msg_id: str):
     yield "data: [DONE]\n\n"
 
 
-async def run_agent_for_clm(user_message: str, state: AppState, conversation_history: list = None) -> str:
+async def run_agent_for_clm(user_message: str, state: AppState, conversation_history: list[ChatMessage] = None) -> str:
     """
     Run the Pydantic AI agent and return text response for CLM.
     This gives voice the SAME brain as CopilotKit chat.
     """
     try:
-        from pydantic_ai.messages import ModelMessage, ModelRequest, UserPromptPart, ModelResponse, TextPart
+        from pydantic_ai.messages import ModelResponse, TextPart
 
         deps = StateDeps(state)
 
@@ -858,9 +1454,9 @@ async def run_agent_for_clm(user_message: str, state: AppState, conversation_his
         message_history = []
         if conversation_history:
             for msg in conversation_history[:-1]:  # Exclude current message
-                role = msg.get("role", "user")
-                content = msg.get("content", "")
-                if isinstance(content, str) and content.strip():
+                role = msg.role
+                content = msg.text
+                if content.strip():
                     if role == "user":
                         message_history.append(
                             ModelRequest(parts=[UserPromptPart(content=content)])
@@ -901,67 +1497,71 @@ async def clm_endpoint(request: Request):
     OpenAI-compatible CLM endpoint for Hume EVI voice.
     This gives voice the SAME brain as CopilotKit chat - full agent with tools.
     """
-    import asyncio
-    import time
-
     global _last_clm_request
 
+    body = parse_body(ClmRequest, await request.body())
+
+    turn_key = None
+    is_new = False
+
     try:
-        body = await request.json()
-        messages = body.get("messages", [])
+        messages = body.messages
 
         # Store for debugging
         _last_clm_request = {
             "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
-            "body_keys": list(body.keys()),
-            "custom_session_id": body.get("custom_session_id"),
-            "customSessionId": body.get("customSessionId"),
-            "session_id": body.get("session_id"),
-            "metadata": body.get("metadata", {}),
+            "body_keys": sorted(body.model_fields_set | set(body.model_extra or {})),
+            "custom_session_id": body.custom_session_id,
+            "customSessionId": body.customSessionId,
+            "session_id": body.session_id,
+            "metadata": body.metadata.model_dump(exclude_none=True),
             "headers": {k: v for k, v in request.headers.items() if "session" in k.lower() or "hume" in k.lower()},
-            "messages": [{"role": m.get("role"), "content_preview": str(m.get("content", ""))[:500]} for m in messages]
+            "messages": [{"role": m.role, "content_preview": m.text[:500]} for m in messages]
         }
 
         print(f"[CLM] === REQUEST ===", file=sys.stderr)
 
-        # Extract session ID (format: "userName|userId")
+        # Identity first - every enrichment step is keyed on the user id
+        user_name, user_id = resolve_identity(request, body)
+        record_identity(user_name, user_id)
         session_id = extract_session_id(request, body)
-        parsed = parse_session_id(session_id)
-        user_name = parsed["user_name"]
-        user_id = parsed["user_id"]
-
-        # Fallback: extract from system messages
-        if not user_name or not user_id:
-            msg_parsed = extract_user_from_messages(messages)
-            if not user_name and msg_parsed["user_name"]:
-                user_name = msg_parsed["user_name"]
-            if not user_id and msg_parsed["user_id"]:
-                user_id = msg_parsed["user_id"]
-
+        record_usage_identity(session_id, user_id)
         print(f"[CLM] User: name={user_name}, id={user_id}", file=sys.stderr)
 
         # Extract user message
         user_msg = ""
         for msg in reversed(messages):
-            if msg.get("role") == "user":
-                user_msg = msg.get("content", "")
+            if msg.role == "user":
+                user_msg = msg.text
                 break
 
         if not user_msg:
             user_msg = "Hello"
 
         print(f"[CLM] Message: {user_msg[:80]}...", file=sys.stderr)
+        msg_id = f"clm-{hash(user_msg) % 100000}"
 
-        # Get Zep context for the user
-        zep_context = ""
-        if user_id and zep_client:
-            try:
-                await get_or_create_zep_user(user_id, None, user_name)
-                zep_context = await get_user_context(user_id)
-                if zep_context:
-                    print(f"[CLM] Zep context: {zep_context[:100]}...", file=sys.stderr)
-            except Exception as e:
-                print(f"[CLM] Zep error: {e}", file=sys.stderr)
+        # A retried turn replays the first attempt's response
+        turn_key = turn_idempotency_key(session_id, user_id, messages, user_msg)
+        if turn_key:
+            turn, is_new = begin_turn(turn_key)
+            _last_clm_request["idempotency_key"] = turn_key
+            _last_clm_request["replayed"] = not is_new
+            if not is_new:
+                print(f"[CLM] Retry of turn {turn_key[:12]} - replaying response", file=sys.stderr)
+                try:
+                    response_text = await asyncio.wait_for(asyncio.shield(turn), TURN_CACHE_TTL)
+                except asyncio.TimeoutError:
+                    response_text = None
+                if response_text is not None:
+                    return StreamingResponse(
+                        stream_sse_response(response_text, msg_id),
+                        media_type="text/event-stream"
+                    )
+                # The original attempt never answered - take the turn over
+                print(f"[CLM] Turn {turn_key[:12]} unanswered - running it again", file=sys.stderr)
+                abandon_turn(turn_key, turn)
+                turn, is_new = begin_turn(turn_key)
 
         # Build state with user profile and Zep context
         user_profile = UserProfile(
@@ -973,16 +1573,38 @@ async def clm_endpoint(request: Request):
             current_price=0,
             current_region="england",
             current_buyer_type="standard",
-            last_calculation=None,
+            last_calculation=_session_calculations.get(session_id) if session_id else None,
             user=user_profile,
-            zep_context=zep_context
         )
+        state._turn_key = turn_key
+
+        # Zep provisioning, Zep context and DB profile run concurrently within the budget
+        if user_id:
+            steps = {"profile": load_user_profile(user_id)}
+            if zep_client:
+                steps["zep_user"] = get_or_create_zep_user(user_id, None, user_name)
+                steps["zep_context"] = load_zep_facts(user_id)
+            results, report = await run_enrichment(steps)
+            apply_user_context(state, results.get("profile"), results.get("zep_context"))
+            _last_clm_request["enrichment"] = report
+            if state.zep_context:
+                print(f"[CLM] Zep context: {state.zep_context[:100]}...", file=sys.stderr)
 
         # Run the actual Pydantic AI agent with full context
         response_text = await run_agent_for_clm(user_msg, state, conversation_history=messages)
-
-        # Fallback if agent fails
-        if not response_text:
+        usage = current_usage()
+        if usage is not None:
+            _last_clm_request["usage"] = usage.to_dict()
+
+        if session_id and state.last_calculation is not None:
+            _session_calculations[session_id] = state.last_calculation
+            _session_calculations.move_to_end(session_id)
+            if len(_session_calculations) > IDENTITY_CACHE_SIZE:
+                _session_calculations.popitem(last=False)
+
+        # Fallback if agent fails - answered, but never cached, so a retry runs the agent again
+        agent_failed = not response_text
+        if agent_failed:
             if user_name:
                 response_text = f"Hi {user_name}! I can help you calculate stamp duty. What property price and location are you looking at?"
             else:
@@ -990,11 +1612,16 @@ async def clm_endpoint(request: Request):
 
         print(f"[CLM] Response: {response_text[:80]}...", file=sys.stderr)
 
-        # Store to Zep memory (fire and forget)
+        if turn_key:
+            if agent_failed:
+                abandon_turn(turn_key, turn, response_text)
+            elif not turn.done():
+                turn.set_result(response_text)
+
+        # Store to Zep memory (fire and forget) - once per turn, retries never reach here
         if user_id and zep_client and user_msg:
             asyncio.create_task(add_conversation_to_zep(user_id, user_msg, response_text))
 
-        msg_id = f"clm-{hash(user_msg) % 100000}"
         return StreamingResponse(
             stream_sse_response(response_text, msg_id),
             media_type="text/event-stream"
@@ -1005,10 +1632,17 @@ async def clm_endpoint(request: Request):
         import traceback
         traceback.print_exc(file=sys.stderr)
         error_response = f"Sorry, I encountered an error. Please try again."
+        # Let waiting retries answer too, but don't keep the failure for later ones
+        if turn_key and is_new:
+            abandon_turn(turn_key, turn, error_response)
         return StreamingResponse(
             stream_sse_response(error_response, "error"),
             media_type="text/event-stream"
         )
+    finally:
+        # Cancelled (or any other BaseException) before answering: waiting retries run the turn
+        if turn_key and is_new and not turn.done():
+            abandon_turn(turn_key, turn)
 
 
 # Mount AG-UI app
@@ -0,0 +1,183 @@
+"""
+UK stamp duty calculation (England/NI SDLT, Scotland LBTT, Wales LTT).
+Pure functions with no app dependencies, so the bulk job workers can import
+them without loading the agent.
+"""
+
+from dataclasses import dataclass
+
+# England/NI SDLT Rates (2024/25)
+ENGLAND_STANDARD_BANDS = [
+    (250000, 0.0),      # 0% up to £250,000
+    (925000, 0.05),     # 5% £250,001 to £925,000
+    (1500000, 0.10),    # 10% £925,001 to £1,500,000
+    (float('inf'), 0.12) # 12% above £1,500,000
+]
+
+ENGLAND_FIRST_TIME_BANDS = [
+    (425000, 0.0),      # 0% up to £425,000 (first-time buyers)
+    (625000, 0.05),     # 5% £425,001 to £625,000
+]
+
+ENGLAND_ADDITIONAL_SURCHARGE = 0.05  # 5% surcharge on additional properties (increased from 3%)
+
+# Scotland LBTT Rates
+SCOTLAND_STANDARD_BANDS = [
+    (145000, 0.0),      # 0% up to £145,000
+    (250000, 0.02),     # 2% £145,001 to £250,000
+    (325000, 0.05),     # 5% £250,001 to £325,000
+    (750000, 0.10),     # 10% £325,001 to £750,000
+    (float('inf'), 0.12) # 12% above £750,000
+]
+
+SCOTLAND_FIRST_TIME_BANDS = [
+    (175000, 0.0),      # 0% up to £175,000 (first-time buyers)
+    (250000, 0.02),
+    (325000, 0.05),
+    (750000, 0.10),
+    (float('inf'), 0.12)
+]
+
+SCOTLAND_ADS = 0.06  # Additional Dwelling Supplement
+
+# Wales LTT Rates
+WALES_STANDARD_BANDS = [
+    (225000, 0.0),      # 0% up to £225,000
+    (400000, 0.06),     # 6% £225,001 to £400,000
+    (750000, 0.075),    # 7.5% £400,001 to £750,000
+    (1500000, 0.10),    # 10% £750,001 to £1,500,000
+    (float('inf'), 0.12) # 12% above £1,500,000
+]
+
+WALES_HIGHER_RATES_SURCHARGE = 0.04  # 4% surcharge for additional properties
+
+
+@dataclass(slots=True, frozen=True)
+class BandSlice:
+    """Tax due on one rate band. Raw numbers only - display strings are built in to_dict()."""
+    lower: float
+    upper: float  # float('inf') for the top band
+    rate: float   # band rate including any surcharge, as a fraction
+    taxable_amount: float
+    tax_due: float
+
+    def to_dict(self) -> dict:
+        return {
+            "band": f"£{self.lower:,.0f} - £{self.upper:,.0f}" if self.upper != float('inf') else f"Above £{self.lower:,.0f}",
+            "rate": f"{self.rate * 100:.1f}%",
+            "taxable_amount": self.taxable_amount,
+            "tax_due": self.tax_due
+        }
+
+
+@dataclass(slots=True, frozen=True)
+class CalculationResult:
+    """Compact stamp duty result. The dict form is only produced when serialized."""
+    purchase_price: float
+    region: str       # normalized, e.g. 'england'
+    buyer_type: str   # normalized, e.g. 'first-time'
+    total_tax: float
+    effective_rate: float
+    bands: tuple[BandSlice, ...]
+
+    def to_dict(self) -> dict:
+        return {
+            "purchase_price": self.purchase_price,
+            "region": self.region.title(),
+            "buyer_type": self.buyer_type.replace('-', ' ').title(),
+            "total_tax": self.total_tax,
+            "effective_rate": self.effective_rate,
+            "breakdown": [band.to_dict() for band in self.bands]
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "CalculationResult":
+        """Rebuild from the serialized form (e.g. AG-UI state echoed back by the frontend)."""
+        return calculate_stamp_duty(
+            float(data["purchase_price"]),
+            data["region"],
+            data["buyer_type"].replace(' ', '-')
+        )
+
+
+def calculate_stamp_duty(
+    price: float,
+    region: str,
+    buyer_type: str
+) -> CalculationResult:
+    """
+    Calculate UK stamp duty based on price, region, and buyer type.
+
+    Args:
+        price: Property purchase price in GBP
+        region: 'england', 'scotland', or 'wales'
+        buyer_type: 'standard', 'first-time', or 'additional'
+
+    Returns:
+        CalculationResult with total_tax, effective_rate, and per-band slices
+
+    Raises:
+        ValueError: If the region is not recognised
+    """
+    region = region.lower()
+    buyer_type = buyer_type.lower()
+
+    # Select appropriate bands and surcharge
+    if region == 'england':
+        if buyer_type == 'first-time' and price <= 625000:
+            bands = ENGLAND_FIRST_TIME_BANDS
+            surcharge = 0.0
+        elif buyer_type == 'additional':
+            bands = ENGLAND_STANDARD_BANDS
+            surcharge = ENGLAND_ADDITIONAL_SURCHARGE
+        else:
+            bands = ENGLAND_STANDARD_BANDS
+            surcharge = 0.0
+
+    elif region == 'scotland':
+        if buyer_type == 'first-time':
+            bands = SCOTLAND_FIRST_TIME_BANDS
+            surcharge = 0.0
+        elif buyer_type == 'additional':
+            bands = SCOTLAND_STANDARD_BANDS
+            surcharge = SCOTLAND_ADS
+        else:
+            bands = SCOTLAND_STANDARD_BANDS
+            surcharge = 0.0
+
+    elif region == 'wales':
+        # Wales doesn't have first-time buyer relief
+        bands = WALES_STANDARD_BANDS
+        surcharge = WALES_HIGHER_RATES_SURCHARGE if buyer_type == 'additional' else 0.0
+
+    else:
+        raise ValueError(f"Unknown region: {region}. Use 'england', 'scotland', or 'wales'.")
+
+    # Calculate tax for each band
+    slices = []
+    total_tax = 0.0
+    previous_threshold = 0
+
+    for threshold, rate in bands:
+        if price > previous_threshold:
+            taxable_in_band = min(price, threshold) - previous_threshold
+            if taxable_in_band > 0:
+                effective_rate = rate + surcharge
+                tax_in_band = taxable_in_band * effective_rate
+                total_tax += tax_in_band
+                slices.append(BandSlice(previous_threshold, threshold, effective_rate, taxable_in_band, tax_in_band))
+
+        previous_threshold = threshold
+        if price <= threshold:
+            break
+
+    effective_rate = (total_tax / price * 100) if price > 0 else 0
+
+    return CalculationResult(
+        purchase_price=price,
+        region=region,
+        buyer_type=buyer_type,
+        total_tax=round(total_tax, 2),
+        effective_rate=round(effective_rate, 2),
+        bands=tuple(slices)
+    )
@@ -0,0 +1,376 @@
+"""
+Local job queue for bulk stamp duty calculations.
+An uploaded portfolio CSV is split into chunk input files, and a process pool
+runs each chunk through calculate_stamp_duty into its own result file (written
+atomically). Job and chunk progress is checkpointed in SQLite next to the files,
+so after a restart only the chunks without a checkpoint are run again. Finished
+chunks can be downloaded while the rest of the job is still running. Completed
+and failed jobs are deleted, files and rows, once JOBS_RETENTION_SECONDS old.
+"""
+
+import os
+import csv
+import sys
+import math
+import time
+import uuid
+import shutil
+import asyncio
+import sqlite3
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import AsyncIterator, Iterator, Optional
+
+from .calculator import calculate_stamp_duty
+
+JOBS_DIR = Path(os.environ.get("JOBS_DIR", "/tmp/stamp-duty-jobs"))
+JOBS_CHUNK_SIZE = int(os.environ.get("JOBS_CHUNK_SIZE", "1000"))
+JOBS_WORKERS = int(os.environ.get("JOBS_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+JOBS_MAX_UPLOAD_BYTES = int(os.environ.get("JOBS_MAX_UPLOAD_BYTES", str(100 * 1024 * 1024)))
+JOBS_RETENTION_SECONDS = float(os.environ.get("JOBS_RETENTION_SECONDS", str(7 * 24 * 3600)))
+JOBS_CLEANUP_INTERVAL = float(os.environ.get("JOBS_CLEANUP_INTERVAL", "3600"))
+JOBS_POOL_RESTARTS = 3
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+
+PRICE_COLUMNS = ("price", "purchase_price")
+RESULT_COLUMNS = ["row", "price", "region", "buyer_type", "total_tax", "effective_rate", "error"]
+
+
+# ============================================================================
+# CHUNK FILES (run in worker processes)
+# ============================================================================
+
+def _chunk_name(kind: str, index: int) -> str:
+    return f"{kind}-{index:05d}.csv"
+
+
+def split_upload(upload: Path, job_dir: Path, chunk_size: int) -> int:
+    """
+    Split an uploaded portfolio CSV into chunk input files; returns the row count.
+    Needs a price (or purchase_price) column; region and buyer_type are optional.
+
+    Raises:
+        ValueError: If the file has no header or no price column
+    """
+    with open(upload, newline="", encoding="utf-8-sig") as f:
+        reader = csv.reader(f)
+        header = [name.strip().lower() for name in next(reader, [])]
+        price_col = next((header.index(c) for c in PRICE_COLUMNS if c in header), None)
+        if price_col is None:
+            raise ValueError(f"CSV needs a header row with one of: {', '.join(PRICE_COLUMNS)}")
+        region_col = header.index("region") if "region" in header else None
+        buyer_col = header.index("buyer_type") if "buyer_type" in header else None
+
+        def cell(values: list, col: Optional[int], default: str) -> str:
+            return values[col].strip() if col is not None and col < len(values) and values[col].strip() else default
+
+        total = 0
+        out = writer = None
+        for values in reader:
+            if not any(v.strip() for v in values):
+                continue
+            if total % chunk_size == 0:
+                if out:
+                    out.close()
+                out = open(job_dir / _chunk_name("input", total // chunk_size), "w", newline="", encoding="utf-8")
+                writer = csv.writer(out)
+            writer.writerow([
+                total,
+                values[price_col] if price_col < len(values) else "",
+                cell(values, region_col, "england"),
+                cell(values, buyer_col, "standard"),
+            ])
+            total += 1
+        if out:
+            out.close()
+    return total
+
+
+def process_chunk(input_path: str, output_path: str) -> tuple[int, int]:
+    """Calculate one chunk into its result file. Returns (rows, errors)."""
+    rows = errors = 0
+    tmp_path = output_path + ".tmp"
+    with open(input_path, newline="", encoding="utf-8") as src, open(tmp_path, "w", newline="", encoding="utf-8") as dst:
+        writer = csv.writer(dst)
+        for row, raw_price, region, buyer_type in csv.reader(src):
+            rows += 1
+            try:
+                price = float(raw_price.replace("£", "").replace(",", "").strip())
+                if not math.isfinite(price) or price < 0:
+                    raise ValueError(f"Price must be a finite, non-negative number: {raw_price!r}")
+                result = calculate_stamp_duty(price, region, buyer_type)
+                writer.writerow([row, price, result.region, result.buyer_type, result.total_tax, result.effective_rate, ""])
+            except ValueError as e:
+                errors += 1
+                writer.writerow([row, raw_price, region, buyer_type, "", "", str(e)])
+    # The rename is what makes the chunk visible - a crash mid-write leaves only the .tmp
+    os.replace(tmp_path, output_path)
+    return rows, errors
+
+
+# ============================================================================
+# CHECKPOINT STORE (SQLite)
+# ============================================================================
+
+class JobStore:
+    """Job metadata and per-chunk checkpoints in a local SQLite file."""
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self.directory / "jobs.db", check_same_thread=False, isolation_level=None)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    filename TEXT,
+                    total_rows INTEGER NOT NULL,
+                    total_chunks INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    error TEXT
+                );
+                CREATE TABLE IF NOT EXISTS chunks (
+                    job_id TEXT NOT NULL,
+                    idx INTEGER NOT NULL,
+                    rows INTEGER NOT NULL,
+                    errors INTEGER NOT NULL,
+                    PRIMARY KEY (job_id, idx)
+                );
+            """)
+        return self._conn
+
+    def job_dir(self, job_id: str) -> Path:
+        return self.directory / job_id
+
+    def create(self, job_id: str, filename: Optional[str], total_rows: int, total_chunks: int):
+        now = time.time()
+        with self._lock:
+            self._db().execute(
+                "INSERT INTO jobs (id, status, filename, total_rows, total_chunks, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, QUEUED, filename, total_rows, total_chunks, now, now),
+            )
+
+    def set_status(self, job_id: str, status: str, error: str = None):
+        with self._lock:
+            self._db().execute(
+                "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                (status, error, time.time(), job_id),
+            )
+
+    def checkpoint(self, job_id: str, index: int, rows: int, errors: int):
+        with self._lock:
+            db = self._db()
+            db.execute("INSERT OR REPLACE INTO chunks (job_id, idx, rows, errors) VALUES (?, ?, ?, ?)", (job_id, index, rows, errors))
+            db.execute("UPDATE jobs SET updated_at = ? WHERE id = ?", (time.time(), job_id))
+
+    def done_chunks(self, job_id: str) -> list[int]:
+        with self._lock:
+            return [r["idx"] for r in self._db().execute("SELECT idx FROM chunks WHERE job_id = ? ORDER BY idx", (job_id,))]
+
+    def unfinished(self) -> list[str]:
+        with self._lock:
+            return [r["id"] for r in self._db().execute("SELECT id FROM jobs WHERE status IN (?, ?) ORDER BY created_at", (QUEUED, RUNNING))]
+
+    def expire(self, max_age: float) -> int:
+        """
+        Delete finished jobs (and their files) last updated more than max_age seconds ago,
+        plus job directories that never got a row (uploads that failed midway). Returns the count.
+        """
+        cutoff = time.time() - max_age
+        with self._lock:
+            db = self._db()
+            expired = [r["id"] for r in db.execute(
+                "SELECT id FROM jobs WHERE status IN (?, ?) AND updated_at < ?", (COMPLETED, FAILED, cutoff)
+            )]
+            for job_id in expired:
+                db.execute("DELETE FROM chunks WHERE job_id = ?", (job_id,))
+                db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            known = {r["id"] for r in db.execute("SELECT id FROM jobs")} | set(expired)
+        orphans = [
+            path.name for path in self.directory.iterdir()
+            if path.is_dir() and path.name not in known and path.stat().st_mtime < cutoff
+        ]
+        for job_id in expired + orphans:
+            shutil.rmtree(self.job_dir(job_id), ignore_errors=True)
+        return len(expired) + len(orphans)
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            db = self._db()
+            job = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if job is None:
+                return None
+            done = db.execute(
+                "SELECT COUNT(*) AS chunks, COALESCE(SUM(rows), 0) AS rows, COALESCE(SUM(errors), 0) AS errors FROM chunks WHERE job_id = ?",
+                (job_id,),
+            ).fetchone()
+        return {
+            "job_id": job["id"],
+            "status": job["status"],
+            "filename": job["filename"],
+            "total_rows": job["total_rows"],
+            "rows_done": done["rows"],
+            "row_errors": done["errors"],
+            "total_chunks": job["total_chunks"],
+            "chunks_done": done["chunks"],
+            "progress": round(done["rows"] / job["total_rows"], 4) if job["total_rows"] else 1.0,
+            "created_at": job["created_at"],
+            "updated_at": job["updated_at"],
+            "error": job["error"],
+        }
+
+
+# ============================================================================
+# JOB MANAGER
+# ============================================================================
+
+class JobManager:
+    """Owns the process pool and one runner task per active job."""
+
+    def __init__(self, store: JobStore, workers: int = JOBS_WORKERS, chunk_size: int = JOBS_CHUNK_SIZE):
+        self.store = store
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.pool: Optional[ProcessPoolExecutor] = None
+        self.runners: dict[str, asyncio.Task] = {}
+        self.cleanup_task: Optional[asyncio.Task] = None
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        # spawn: workers import only this module and the calculator, never the forked app state
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def start(self):
+        """Create the pool and resume any job left queued or running by the last process."""
+        self.pool = self._new_pool()
+        resumed = self.store.unfinished()
+        for job_id in resumed:
+            self.schedule(job_id)
+        self.cleanup_task = asyncio.create_task(self._cleanup_loop())
+        print(f"[JOBS] Pool started ({self.workers} workers), resumed {len(resumed)} jobs", file=sys.stderr)
+
+    async def stop(self):
+        tasks = [*self.runners.values(), *([self.cleanup_task] if self.cleanup_task else [])]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.cleanup_task = None
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+    async def submit(self, chunks: AsyncIterator[bytes], filename: Optional[str] = None) -> str:
+        """
+        Stream an upload to disk, split it into chunks and queue the job.
+
+        Raises:
+            ValueError: If the upload is too large or not a usable portfolio CSV
+        """
+        job_id = uuid.uuid4().hex
+        job_dir = self.store.job_dir(job_id)
+        job_dir.mkdir(parents=True)
+        upload = job_dir / "upload.csv"
+        try:
+            size = 0
+            with open(upload, "wb") as f:
+                async for data in chunks:
+                    size += len(data)
+                    if size > JOBS_MAX_UPLOAD_BYTES:
+                        raise ValueError(f"Upload larger than {JOBS_MAX_UPLOAD_BYTES} bytes")
+                    await asyncio.to_thread(f.write, data)
+            total_rows = await asyncio.to_thread(split_upload, upload, job_dir, self.chunk_size)
+        except (ValueError, UnicodeDecodeError, csv.Error) as e:
+            shutil.rmtree(job_dir, ignore_errors=True)
+            raise ValueError(str(e)) from e
+        upload.unlink()
+
+        total_chunks = -(-total_rows // self.chunk_size)
+        await asyncio.to_thread(self.store.create, job_id, filename, total_rows, total_chunks)
+        self.schedule(job_id)
+        print(f"[JOBS] Queued {job_id}: {total_rows} rows in {total_chunks} chunks", file=sys.stderr)
+        return job_id
+
+    async def _cleanup_loop(self):
+        """Expire old jobs at startup and then on an interval."""
+        while True:
+            try:
+                expired = await asyncio.to_thread(self.store.expire, JOBS_RETENTION_SECONDS)
+                if expired:
+                    print(f"[JOBS] Expired {expired} old jobs", file=sys.stderr)
+            except (OSError, sqlite3.Error) as e:
+                print(f"[JOBS] Cleanup error: {e}", file=sys.stderr)
+            await asyncio.sleep(JOBS_CLEANUP_INTERVAL)
+
+    def schedule(self, job_id: str):
+        if job_id not in self.runners:
+            task = asyncio.create_task(self._run(job_id))
+            self.runners[job_id] = task
+            task.add_done_callback(lambda _: self.runners.pop(job_id, None))
+
+    async def _run(self, job_id: str):
+        # SQLite calls go through worker threads like the file I/O, never on the loop
+        job = await asyncio.to_thread(self.store.get, job_id)
+        job_dir = self.store.job_dir(job_id)
+        await asyncio.to_thread(self.store.set_status, job_id, RUNNING)
+        loop = asyncio.get_running_loop()
+
+        for attempt in range(JOBS_POOL_RESTARTS + 1):
+            pool = self.pool
+            done = set(await asyncio.to_thread(self.store.done_chunks, job_id))
+            pending = [i for i in range(job["total_chunks"]) if i not in done]
+
+            async def run_chunk(index: int):
+                rows, errors = await loop.run_in_executor(
+                    pool, process_chunk,
+                    str(job_dir / _chunk_name("input", index)), str(job_dir / _chunk_name("result", index)),
+                )
+                await asyncio.to_thread(self.store.checkpoint, job_id, index, rows, errors)
+
+            # Shutdown cancels this task; the job stays RUNNING and resumes from its checkpoints on next start
+            outcomes = await asyncio.gather(*(run_chunk(i) for i in pending), return_exceptions=True)
+            failures = [e for e in outcomes if isinstance(e, BaseException)]
+            if not failures:
+                await asyncio.to_thread(self.store.set_status, job_id, COMPLETED)
+                print(f"[JOBS] Completed {job_id}", file=sys.stderr)
+                return
+            if not all(isinstance(e, BrokenProcessPool) for e in failures):
+                error = next(e for e in failures if not isinstance(e, BrokenProcessPool))
+                print(f"[JOBS] {job_id} failed: {error!r}", file=sys.stderr)
+                await asyncio.to_thread(self.store.set_status, job_id, FAILED, f"{type(error).__name__}: {error}")
+                return
+
+            # A worker died; checkpointed chunks are kept and the rest run on a fresh pool
+            print(f"[JOBS] Worker pool broke on {job_id}, restarting (attempt {attempt + 1})", file=sys.stderr)
+            if self.pool is pool:
+                pool.shutdown(wait=False, cancel_futures=True)
+                self.pool = self._new_pool()
+        await asyncio.to_thread(self.store.set_status, job_id, FAILED, "worker pool kept crashing")
+
+    def result_rows(self, job_id: str) -> Iterator[bytes]:
+        """CSV of every checkpointed chunk so far, in row order."""
+        job_dir = self.store.job_dir(job_id)
+        yield (",".join(RESULT_COLUMNS) + "\n").encode()
+        for index in self.store.done_chunks(job_id):
+            path = job_dir / _chunk_name("result", index)
+            if path.is_file():
+                with open(path, "rb") as f:
+                    while data := f.read(64 * 1024):
+                        yield data
+
+
+job_store = JobStore(JOBS_DIR)
+job_manager = JobManager(job_store)
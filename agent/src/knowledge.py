@@ -0,0 +1,260 @@
+"""
+In-process BM25 knowledge index.
+Snippets come from markdown files in the knowledge directory (one snippet per
+"## " section) and, when a database is configured, published rows of the
+mdx_content table. Only the top-k snippets for the current question are
+injected into the prompt.
+"""
+
+import re
+import sys
+import math
+import threading
+from array import array
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+# Neon PostgreSQL
+import psycopg2
+
+TOKEN_RE = re.compile(r"\d+(?:\.\d+)?[km]?|[a-z][a-z0-9]*")
+# "£625,000" and "625k" index as the same term; commas between digit groups are dropped first
+THOUSANDS_RE = re.compile(r"(?<=\d),(?=\d{3}\b)")
+NUMBER_SUFFIXES = {"k": 1_000, "m": 1_000_000}
+STOPWORDS = frozenset("""
+a an and are as at be buy by can do does for from has have how i if in is it its
+me my no not of on or so than that the their there this to up was we what when
+where which who will with you your about also any current much tell
+""".split())
+# Words in nearly every snippet: they only pull in noise for generic price questions,
+# which the core rates pinned in the prompt already answer
+STOPWORDS |= frozenset("stamp duty tax rate price cost pay paid house property calculate".split())
+
+
+def _number(token: str) -> str:
+    """Canonical form of a numeric token: '450k' and '450000' -> '450000', '1.5m' -> '1500000'."""
+    scale = NUMBER_SUFFIXES.get(token[-1], 1)
+    value = float(token[:-1] if scale > 1 else token) * scale
+    return str(int(value)) if value.is_integer() else str(value)
+
+
+def tokenize(text: str) -> list[str]:
+    """Lowercase word and number tokens with stopwords dropped and plurals folded ('lets' -> 'let')."""
+    tokens = []
+    for token in TOKEN_RE.findall(THOUSANDS_RE.sub("", text.lower())):
+        if token[0].isdigit():
+            tokens.append(_number(token))
+            continue
+        if token in STOPWORDS:
+            continue
+        if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+            token = token[:-1]
+            if token in STOPWORDS:
+                continue
+        tokens.append(token)
+    return tokens
+
+
+@dataclass(slots=True)
+class Snippet:
+    """One indexed passage."""
+    source: str
+    title: str
+    text: str
+    length: int
+    terms: tuple
+
+
+class KnowledgeIndex:
+    """
+    Compact inverted index scored with BM25.
+
+    Postings are parallel arrays of snippet ids and term frequencies. Sources
+    are fingerprinted so refresh() only re-indexes what changed.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+        self._snippets: dict[int, Snippet] = {}
+        self._postings: dict[str, tuple[array, array]] = {}
+        self._sources: dict[str, tuple[str, list[int]]] = {}  # source -> (fingerprint, snippet ids)
+        self._next_id = 0
+        self._total_length = 0
+
+    def __len__(self) -> int:
+        return len(self._snippets)
+
+    def update_source(self, source: str, fingerprint: str, sections: list[tuple[str, str]]) -> bool:
+        """Index (title, text) sections for a source. Returns False if the fingerprint is unchanged."""
+        with self._lock:
+            existing = self._sources.get(source)
+            if existing and existing[0] == fingerprint:
+                return False
+            if existing:
+                self._remove_locked(source)
+
+            ids = []
+            for title, text in sections:
+                tokens = tokenize(f"{title} {text}")
+                if not tokens:
+                    continue
+                counts: dict[str, int] = {}
+                for token in tokens:
+                    counts[token] = counts.get(token, 0) + 1
+
+                snippet_id = self._next_id
+                self._next_id += 1
+                self._snippets[snippet_id] = Snippet(source, title, text, len(tokens), tuple(counts))
+                self._total_length += len(tokens)
+                for term, tf in counts.items():
+                    postings = self._postings.get(term)
+                    if postings is None:
+                        postings = self._postings[term] = (array("I"), array("H"))
+                    postings[0].append(snippet_id)
+                    postings[1].append(min(tf, 0xFFFF))
+                ids.append(snippet_id)
+
+            self._sources[source] = (fingerprint, ids)
+            return True
+
+    def remove_source(self, source: str):
+        with self._lock:
+            self._remove_locked(source)
+
+    def _remove_locked(self, source: str):
+        entry = self._sources.pop(source, None)
+        if not entry:
+            return
+        removed = set(entry[1])
+        terms = set()
+        for snippet_id in removed:
+            snippet = self._snippets.pop(snippet_id)
+            self._total_length -= snippet.length
+            terms.update(snippet.terms)
+        for term in terms:
+            ids, tfs = self._postings[term]
+            keep = [i for i, snippet_id in enumerate(ids) if snippet_id not in removed]
+            if keep:
+                self._postings[term] = (array("I", (ids[i] for i in keep)), array("H", (tfs[i] for i in keep)))
+            else:
+                del self._postings[term]
+
+    def search(self, query: str, k: int = 3, min_score: float = 1.0) -> list[Snippet]:
+        """Return up to k snippets ranked by BM25 score."""
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+
+        with self._lock:
+            n = len(self._snippets)
+            if not n:
+                return []
+            avg_length = self._total_length / n
+            scores: dict[int, float] = {}
+            for term in terms:
+                postings = self._postings.get(term)
+                if postings is None:
+                    continue
+                ids, tfs = postings
+                idf = math.log(1 + (n - len(ids) + 0.5) / (len(ids) + 0.5))
+                for snippet_id, tf in zip(ids, tfs):
+                    norm = self.k1 * (1 - self.b + self.b * self._snippets[snippet_id].length / avg_length)
+                    scores[snippet_id] = scores.get(snippet_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+
+            ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+            return [self._snippets[snippet_id] for snippet_id, score in ranked[:k] if score >= min_score]
+
+    def refresh(self, content_dir: Optional[Path] = None, database_url: Optional[str] = None,
+                connect_timeout: int = 5) -> dict:
+        """
+        Incrementally sync the index with the content directory and mdx_content table.
+        Unchanged sources are skipped; deleted ones are dropped.
+        """
+        stats = {"updated": 0, "removed": 0}
+        seen = set()
+
+        if content_dir and content_dir.is_dir():
+            for path in sorted(content_dir.glob("*.md")):
+                source = f"file:{path.name}"
+                seen.add(source)
+                stat = path.stat()
+                fingerprint = f"{stat.st_mtime_ns}:{stat.st_size}"
+                if self._sources.get(source, ("",))[0] == fingerprint:
+                    continue
+                if self.update_source(source, fingerprint, split_markdown(path.read_text(encoding="utf-8"))):
+                    stats["updated"] += 1
+
+        db_ok = True
+        if database_url:
+            try:
+                for slug, title, content, updated_at in fetch_mdx_content(database_url, connect_timeout):
+                    source = f"mdx:{slug}"
+                    seen.add(source)
+                    if self.update_source(source, str(updated_at), [(title, mdx_to_text(content))]):
+                        stats["updated"] += 1
+            except Exception as e:
+                # Keep the previously indexed rows rather than dropping them
+                print(f"[KNOWLEDGE] mdx_content error: {e}", file=sys.stderr)
+                db_ok = False
+
+        for source in list(self._sources):
+            if source in seen or (source.startswith("mdx:") and not db_ok):
+                continue
+            self.remove_source(source)
+            stats["removed"] += 1
+
+        stats["snippets"] = len(self)
+        return stats
+
+
+def split_markdown(text: str) -> list[tuple[str, str]]:
+    """Split markdown into (heading, body) sections on '## ' headings, prefixed by the '# ' title."""
+    sections = []
+    doc_title = ""
+    title = ""
+    body: list[str] = []
+    for line in text.splitlines():
+        if line.startswith("## "):
+            if body:
+                sections.append((title, " ".join(body)))
+            heading = line[3:].strip()
+            title, body = (f"{doc_title}: {heading}" if doc_title else heading), []
+        elif line.startswith("# "):
+            doc_title = title = line[2:].strip()
+        elif line.strip():
+            body.append(line.strip())
+    if body:
+        sections.append((title, " ".join(body)))
+    return sections
+
+
+MDX_STRING_RE = re.compile(r'"([^"]+)"')
+MDX_TAG_RE = re.compile(r"<[^>]*>")
+
+
+def mdx_to_text(content: str) -> str:
+    """Flatten MDX component markup into plain text (string props plus text nodes)."""
+    strings = MDX_STRING_RE.findall(content)
+    text_nodes = " ".join(MDX_TAG_RE.sub(" ", content).split())
+    return "; ".join(strings + ([text_nodes] if text_nodes else []))
+
+
+def fetch_mdx_content(database_url: str, connect_timeout: int = 5) -> list[tuple]:
+    """Load published mdx_content rows as (slug, title, content, updated_at)."""
+    # Bounded like db_connect(), so an unreachable Neon fails fast instead of holding the thread
+    conn = psycopg2.connect(database_url, connect_timeout=connect_timeout)
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT slug, title, content, updated_at
+            FROM mdx_content
+            WHERE is_published = TRUE
+        """)
+        rows = cur.fetchall()
+        cur.close()
+        return rows
+    finally:
+        conn.close()
@@ -4,7 +4,7 @@ import uvicorn
 
 if __name__ == "__main__":
     uvicorn.run(
-        "agent:app",
+        "src.agent:app",
         host="0.0.0.0",
         port=8000,
         reload=True
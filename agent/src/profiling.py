@@ -0,0 +1,216 @@
+"""
+Opt-in per-request profiling.
+A sampling profiler walks the event loop thread (plus asyncio.to_thread and
+breaker workers) while a request is in flight and writes collapsed-stack and
+speedscope files to a bounded directory. Requests are profiled when they carry
+the trigger header, are picked by the sample rate, or - in slow mode - exceed
+the latency threshold. Nothing is installed unless PROFILE_ENABLED is set.
+
+Those threads are shared, so a profile also contains the frames of any other
+requests served at the same time: it shows what the process was doing during
+the request, not that request alone.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import threading
+from collections import Counter
+from pathlib import Path
+from typing import Optional
+
+from .resilience import WORKER_THREAD_PREFIX as BREAKER_THREAD_PREFIX
+
+PROFILE_ENABLED = os.environ.get("PROFILE_ENABLED", "").lower() in ("1", "true", "yes")
+PROFILE_HEADER = os.environ.get("PROFILE_HEADER", "x-profile").lower().encode()
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_SLOW_MS = float(os.environ.get("PROFILE_SLOW_MS", "0"))
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", "5"))
+PROFILE_DIR = Path(os.environ.get("PROFILE_DIR", "/tmp/stamp-duty-profiles"))
+PROFILE_MAX_FILES = int(os.environ.get("PROFILE_MAX_FILES", "50"))
+
+# Threads of asyncio.to_thread's default executor and of the Zep/Neon breaker pools
+WORKER_THREAD_PREFIXES = ("asyncio_", BREAKER_THREAD_PREFIX)
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """
+    Samples stacks of the loop thread and executor workers on a background thread.
+    Samples are not attributed to tasks: concurrent requests show up too.
+    """
+
+    def __init__(self, loop_thread_id: int, interval: float):
+        self.loop_thread_id = loop_thread_id
+        self.interval = interval
+        self.counts: Counter = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                name = names.get(thread_id, "")
+                if thread_id != self.loop_thread_id and not name.startswith(WORKER_THREAD_PREFIXES):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                stack.append("event-loop" if thread_id == self.loop_thread_id else name)
+                self.counts[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+
+class ProfileStore:
+    """Bounded on-disk directory of profiles (oldest files are pruned)."""
+
+    def __init__(self, directory: Path, max_files: int):
+        self.directory = directory
+        self.max_files = max_files
+
+    def write(self, name: str, sampler: StackSampler, meta: dict) -> str:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        collapsed = "\n".join(f"{stack} {count}" for stack, count in sampler.counts.most_common())
+        (self.directory / f"{name}.collapsed").write_text(collapsed + "\n", encoding="utf-8")
+        (self.directory / f"{name}.speedscope.json").write_text(
+            json.dumps(to_speedscope(name, sampler.counts, sampler.interval)), encoding="utf-8"
+        )
+        (self.directory / f"{name}.meta.json").write_text(json.dumps(meta), encoding="utf-8")
+        self.prune()
+        return name
+
+    def prune(self):
+        metas = sorted(self.directory.glob("*.meta.json"), key=lambda p: p.stat().st_mtime)
+        for meta in metas[:max(0, len(metas) - self.max_files)]:
+            stem = meta.name[:-len(".meta.json")]
+            for suffix in (".meta.json", ".collapsed", ".speedscope.json"):
+                (self.directory / f"{stem}{suffix}").unlink(missing_ok=True)
+
+    def list(self) -> list[dict]:
+        if not self.directory.is_dir():
+            return []
+        profiles = []
+        for meta in sorted(self.directory.glob("*.meta.json"), key=lambda p: p.stat().st_mtime, reverse=True):
+            try:
+                profiles.append(json.loads(meta.read_text(encoding="utf-8")))
+            except (OSError, ValueError):
+                continue
+        return profiles
+
+    def path(self, filename: str) -> Optional[Path]:
+        """Resolve a profile file name inside the store (None if missing or outside it)."""
+        path = (self.directory / filename).resolve()
+        if path.parent != self.directory.resolve() or not path.is_file():
+            return None
+        return path
+
+
+def to_speedscope(name: str, counts: Counter, interval: float) -> dict:
+    """Convert collapsed stacks into a speedscope 'sampled' profile."""
+    frames: list[dict] = []
+    frame_index: dict[str, int] = {}
+    samples = []
+    weights = []
+    for stack, count in counts.items():
+        indexes = []
+        for label in stack.split(";"):
+            if label not in frame_index:
+                frame_index[label] = len(frames)
+                frames.append({"name": label})
+            indexes.append(frame_index[label])
+        samples.append(indexes)
+        weights.append(count * interval * 1000)
+    total = sum(weights)
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "shared": {"frames": frames},
+        "profiles": [{
+            "type": "sampled",
+            "name": name,
+            "unit": "milliseconds",
+            "startValue": 0,
+            "endValue": total,
+            "samples": samples,
+            "weights": weights,
+        }],
+    }
+
+
+profile_store = ProfileStore(PROFILE_DIR, PROFILE_MAX_FILES)
+
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware that profiles whole requests, including streamed bodies.
+    In slow mode every request is sampled and only those over PROFILE_SLOW_MS are kept.
+    """
+
+    def __init__(self, app, store: ProfileStore = profile_store):
+        self.app = app
+        self.store = store
+        self.interval = PROFILE_INTERVAL_MS / 1000
+
+    def _triggered(self, scope) -> Optional[str]:
+        for key, value in scope.get("headers", ()):
+            if key == PROFILE_HEADER and value not in (b"", b"0", b"false"):
+                return "header"
+        if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+            return "sample"
+        if PROFILE_SLOW_MS:
+            return "slow"
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        trigger = self._triggered(scope)
+        if trigger is None:
+            return await self.app(scope, receive, send)
+
+        sampler = StackSampler(threading.get_ident(), self.interval)
+        started = time.perf_counter()
+        sampler.start()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            # Joining the sampler and writing the files both block - keep them off the loop
+            await asyncio.to_thread(sampler.stop)
+            if trigger != "slow" or elapsed_ms >= PROFILE_SLOW_MS:
+                await asyncio.to_thread(self._save, scope, trigger, elapsed_ms, sampler)
+
+    def _save(self, scope, trigger: str, elapsed_ms: float, sampler: StackSampler):
+        path = scope.get("path", "/")
+        slug = path.strip("/").replace("/", "_") or "root"
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{int(time.time() * 1000) % 1000:03d}-{slug}-{elapsed_ms:.0f}ms"
+        meta = {
+            "name": name,
+            "path": path,
+            "method": scope.get("method"),
+            "trigger": trigger,
+            "duration_ms": round(elapsed_ms, 1),
+            "samples": sampler.samples,
+            "files": [f"{name}.collapsed", f"{name}.speedscope.json"],
+        }
+        try:
+            self.store.write(name, sampler, meta)
+            print(f"[PROFILE] {path} {elapsed_ms:.0f}ms ({trigger}) -> {name}", file=sys.stderr)
+        except OSError as e:
+            print(f"[PROFILE] Write error: {e}", file=sys.stderr)
@@ -0,0 +1,227 @@
+"""
+Replay captured session traces against main_app for offline performance regression.
+
+The model is replaced by a deterministic player that returns the recorded
+responses in order, and Zep and Neon by stubs that serve the profile and facts
+the trace recorded - so enrichment, breakers, caches and prompt rendering run
+as in production, minus the network. Run from the agent/ directory:
+
+    python -m src.replay traces/traces-20260101.jsonl --out before.json
+    git checkout my-branch
+    python -m src.replay traces/traces-20260101.jsonl --baseline before.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import asyncio
+import statistics
+import tracemalloc
+from types import SimpleNamespace
+
+# No real clients: the app module must not see credentials (the stubs are installed below)
+os.environ["ZEP_API_KEY"] = ""
+os.environ["DATABASE_URL"] = ""
+os.environ.pop("TRACE_CAPTURE_DIR", None)
+os.environ.pop("PROFILE_ENABLED", None)
+
+import httpx
+from pydantic_ai.messages import ModelResponse, TextPart, ToolCallPart
+from pydantic_ai.models.function import AgentInfo, DeltaToolCall, FunctionModel
+
+from . import agent as app_module
+from .agent import agent, main_app, knowledge_index, KNOWLEDGE_DIR
+from .tracing import load_message
+from .usage import UsageModel
+
+
+class TracePlayer:
+    """Deterministic stand-in for the model: plays back one trace's recorded responses."""
+
+    def __init__(self, trace: dict):
+        self.responses = [load_message(call["response"]) for call in trace.get("model_calls", [])]
+        self.position = 0
+        self.exhausted = 0
+
+    def _next(self) -> ModelResponse:
+        if self.position >= len(self.responses):
+            # The app asked for more model turns than were recorded - the run diverged
+            self.exhausted += 1
+            return ModelResponse(parts=[TextPart(content="")])
+        response = self.responses[self.position]
+        self.position += 1
+        return response
+
+    def respond(self, messages: list, info: AgentInfo) -> ModelResponse:
+        return self._next()
+
+    async def stream(self, messages: list, info: AgentInfo):
+        response = self._next()
+        for part in response.parts:
+            if isinstance(part, TextPart) and part.content:
+                yield part.content
+        tool_calls = {
+            i: DeltaToolCall(name=part.tool_name, json_args=part.args_as_json_str(), tool_call_id=part.tool_call_id)
+            for i, part in enumerate(response.parts) if isinstance(part, ToolCallPart)
+        }
+        if tool_calls:
+            yield tool_calls
+
+    def model(self) -> FunctionModel:
+        return FunctionModel(self.respond, stream_function=self.stream)
+
+
+class ReplaySources:
+    """Stand-ins for the Zep client and the Neon query functions that serve one trace's recorded reads."""
+
+    def __init__(self):
+        self.sources: dict = {}
+        user = SimpleNamespace(get=self._zep_user, add=self._zep_user, get_context=self._zep_context)
+        self.zep = SimpleNamespace(user=user, graph=SimpleNamespace(add=lambda **kwargs: None))
+
+    def install(self):
+        """Point the app at the stubs; calls still go through the breakers and caches."""
+        app_module.DATABASE_URL = "replay"
+        app_module.zep_client = self.zep
+        app_module._fetch_profile_items = self._fetch_profile_items
+        app_module._replace_preference = lambda user_id, preference_type, value: None
+        app_module._insert_calculation = lambda user_id, value, metadata, key: True
+
+    def _zep_user(self, user_id: str = None, **kwargs):
+        return SimpleNamespace(user_id=user_id)
+
+    def _zep_context(self, user_id: str, min_score: float = None):
+        facts = self.sources.get("zep_facts") or []
+        return SimpleNamespace(facts=[SimpleNamespace(fact=fact, score=None) for fact in facts])
+
+    def _fetch_profile_items(self, user_id: str) -> list:
+        # Rebuild the (item_type, value, metadata, created_at) rows the recorded profile came from
+        profile = self.sources.get("profile") or {}
+        rows = [(item_type, value, None, "") for item_type, value in profile.get("preferences", {}).items()]
+        rows += [("calculation", calc["value"], calc["metadata"], calc["date"]) for calc in profile.get("calculation_history", [])]
+        return rows
+
+
+replay_sources = ReplaySources()
+
+
+def load_traces(paths: list[str]) -> list[dict]:
+    traces = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            traces.extend(json.loads(line) for line in f if line.strip())
+    return traces
+
+
+def reset_request_caches():
+    """Forget per-process turn, session, identity and profile state so a replay is never answered from cache."""
+    app_module._turn_responses.clear()
+    app_module._session_calculations.clear()
+    app_module._identity_cache.clear()
+    app_module._profile_cache.clear()
+    app_module._zep_facts_cache.clear()
+
+
+async def replay_trace(client: httpx.AsyncClient, trace: dict) -> dict:
+    """Replay one trace and return its latency, allocation and divergence figures."""
+    player = TracePlayer(trace)
+    body = trace["body"]
+    replay_sources.sources = trace.get("sources") or {}
+    reset_request_caches()
+
+    tracemalloc.reset_peak()
+    before, _ = tracemalloc.get_traced_memory()
+    # The lifespan (which attaches the real model) never runs under ASGITransport
+    agent.model = UsageModel(player.model())
+    started = time.perf_counter()
+    async with client.stream("POST", trace["path"], json=body) as response:
+        async for _ in response.aiter_bytes():
+            pass
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    _, peak = tracemalloc.get_traced_memory()
+
+    return {
+        "path": trace["path"],
+        "status": response.status_code,
+        "latency_ms": elapsed_ms,
+        "alloc_peak_kb": (peak - before) / 1024,
+        "model_calls": player.position,
+        "diverged": player.exhausted > 0 or player.position < len(player.responses),
+    }
+
+
+def summarize(results: list[dict]) -> dict:
+    """Aggregate per endpoint: count, p50/p95 latency, mean peak allocation, divergences."""
+    summary = {}
+    for path in sorted({r["path"] for r in results}):
+        rows = [r for r in results if r["path"] == path]
+        latencies = sorted(r["latency_ms"] for r in rows)
+        summary[path] = {
+            "requests": len(rows),
+            "p50_ms": round(statistics.median(latencies), 2),
+            "p95_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 2),
+            "mean_alloc_peak_kb": round(statistics.fmean(r["alloc_peak_kb"] for r in rows), 1),
+            "diverged": sum(r["diverged"] for r in rows),
+        }
+    return summary
+
+
+def print_report(summary: dict, baseline: dict = None):
+    for path, row in summary.items():
+        line = f"{path:<22} n={row['requests']:<5} p50={row['p50_ms']:>8.2f}ms p95={row['p95_ms']:>8.2f}ms alloc={row['mean_alloc_peak_kb']:>8.1f}KB"
+        base = (baseline or {}).get(path)
+        if base:
+            for key, label in (("p50_ms", "p50"), ("p95_ms", "p95"), ("mean_alloc_peak_kb", "alloc")):
+                if base[key]:
+                    line += f" {label} {(row[key] - base[key]) / base[key] * 100:+.1f}%"
+        if row["diverged"]:
+            line += f" (diverged: {row['diverged']})"
+        print(line)
+
+
+async def main(argv: list[str] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("traces", nargs="+", help="Trace JSONL files written by TRACE_CAPTURE_DIR")
+    parser.add_argument("--repeat", type=int, default=3, help="Replay the whole set this many times")
+    parser.add_argument("--warmup", type=int, default=1, help="Untimed passes before measuring")
+    parser.add_argument("--out", help="Write the summary JSON here")
+    parser.add_argument("--baseline", help="Summary JSON from another commit to diff against")
+    args = parser.parse_args(argv)
+
+    traces = load_traces(args.traces)
+    if not traces:
+        print("No traces found", file=sys.stderr)
+        return 1
+    knowledge_index.refresh(KNOWLEDGE_DIR)
+    replay_sources.install()
+
+    transport = httpx.ASGITransport(app=main_app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://replay") as client:
+        for _ in range(args.warmup):
+            for trace in traces:
+                await replay_trace(client, trace)
+
+        tracemalloc.start()
+        results = []
+        for _ in range(args.repeat):
+            for trace in traces:
+                results.append(await replay_trace(client, trace))
+        tracemalloc.stop()
+
+    summary = summarize(results)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(summary, baseline)
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
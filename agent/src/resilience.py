@@ -0,0 +1,214 @@
+"""
+Circuit breakers and bulkheads for the blocking Zep and Neon clients.
+Each dependency gets one breaker that runs its calls on its own worker threads
+with a per-call timeout. The breaker opens when the failure rate over a sliding window
+crosses a threshold, rejects calls instantly while open, then lets a few probe
+calls through (half-open) to decide whether to close again. A separate
+concurrency limit (the bulkhead) caps how many worker threads one dependency
+can hold, including calls that have already timed out but not yet returned.
+The threads come from a pool per breaker, sized to that limit, so a hung
+dependency cannot starve the other one or the event loop's default executor.
+"""
+
+import os
+import sys
+import time
+import asyncio
+import functools
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Worker threads are named e.g. "breaker-zep_0" (the profiler samples them too)
+WORKER_THREAD_PREFIX = "breaker-"
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a dependency that is open or whose bulkhead is full."""
+
+    def __init__(self, name: str, reason: str):
+        super().__init__(f"{name} unavailable ({reason})")
+        self.name = name
+        self.reason = reason
+
+
+@dataclass(frozen=True)
+class BreakerSettings:
+    """Failure window, trip threshold, recovery and bulkhead settings for one dependency."""
+    window_seconds: float
+    min_calls: int
+    failure_rate: float
+    open_seconds: float
+    half_open_probes: int
+    max_concurrent: int
+    call_timeout: float
+
+    @classmethod
+    def from_env(cls, prefix: str, **defaults) -> "BreakerSettings":
+        """Read e.g. ZEP_BREAKER_FAILURE_RATE, falling back to the given defaults."""
+        values = {}
+        for name, default in defaults.items():
+            raw = os.environ.get(f"{prefix}_BREAKER_{name.upper()}")
+            values[name] = type(default)(raw) if raw else default
+        return cls(**values)
+
+
+class CircuitBreaker:
+    """
+    Breaker plus bulkhead around one blocking dependency.
+    `expected_errors` are answers, not outages (e.g. "user not found"): they are
+    re-raised but count as successful calls.
+    All state is touched from the event loop only, so no locking is needed.
+    """
+
+    def __init__(self, name: str, settings: BreakerSettings, expected_errors: tuple[type[Exception], ...] = ()):
+        self.name = name
+        self.settings = settings
+        self.expected_errors = expected_errors
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.outcomes: deque[tuple[float, bool]] = deque()
+        self.in_flight = 0
+        self.probes = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.last_error: Optional[str] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def _pool(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.settings.max_concurrent,
+                thread_name_prefix=f"{WORKER_THREAD_PREFIX}{self.name}",
+            )
+        return self._executor
+
+    def shutdown(self):
+        """Stop the worker pool; calls still hung in a dependency are abandoned, not waited for."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _transition(self, state: str):
+        if state == self.state:
+            return
+        print(f"[BREAKER] {self.name}: {self.state} -> {state}", file=sys.stderr)
+        self.state = state
+        if state == OPEN:
+            self.opened_at = time.monotonic()
+        elif state == CLOSED:
+            self.outcomes.clear()
+
+    def _prune(self, now: float):
+        horizon = now - self.settings.window_seconds
+        while self.outcomes and self.outcomes[0][0] < horizon:
+            self.outcomes.popleft()
+
+    def _reject(self, reason: str):
+        self.rejected += 1
+        raise CircuitOpenError(self.name, reason)
+
+    def _admit(self) -> bool:
+        """Take a bulkhead slot or raise CircuitOpenError. Returns True for a half-open probe."""
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.settings.open_seconds:
+                self._reject("circuit open")
+            self._transition(HALF_OPEN)
+        if self.state == HALF_OPEN and self.probes >= self.settings.half_open_probes:
+            self._reject("probe in progress")
+        if self.in_flight >= self.settings.max_concurrent:
+            self._reject("bulkhead full")
+        self.in_flight += 1
+        probe = self.state == HALF_OPEN
+        if probe:
+            self.probes += 1
+        return probe
+
+    def _record(self, ok: bool, probe: bool, error: str = None):
+        if error:
+            self.last_error = error
+        if probe:
+            self.probes -= 1
+            if self.state == HALF_OPEN:
+                self._transition(CLOSED if ok else OPEN)
+                return
+        if self.state != CLOSED:
+            # Late result of a call admitted before the breaker tripped
+            return
+        now = time.monotonic()
+        self.outcomes.append((now, ok))
+        self._prune(now)
+        failures = sum(1 for _, success in self.outcomes if not success)
+        if len(self.outcomes) >= self.settings.min_calls and failures / len(self.outcomes) >= self.settings.failure_rate:
+            self._transition(OPEN)
+
+    def _release(self, task: asyncio.Future):
+        # The slot is held until the worker thread really finishes, not just until the caller gives up
+        self.in_flight -= 1
+        if not task.cancelled():
+            task.exception()
+
+    async def call(self, fn, *args, **kwargs):
+        """
+        Run a blocking function on the breaker's own worker threads.
+        Raises CircuitOpenError without calling it when the breaker or bulkhead rejects,
+        asyncio.TimeoutError after call_timeout, or whatever the function raised.
+        A caller cancelled while the call is still running counts as a timeout.
+        """
+        probe = self._admit()
+        # Like asyncio.to_thread, but on this dependency's pool (context vars still propagate)
+        context = contextvars.copy_context()
+        task = asyncio.get_running_loop().run_in_executor(
+            self._pool(), functools.partial(context.run, fn, *args, **kwargs)
+        )
+        task.add_done_callback(self._release)
+        try:
+            result = await asyncio.wait_for(asyncio.shield(task), self.settings.call_timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            self._record(False, probe, f"timeout after {self.settings.call_timeout}s")
+            raise
+        except asyncio.CancelledError:
+            if task.done():
+                # Cancelled after the dependency had answered - no verdict on it
+                if probe:
+                    self.probes -= 1
+            else:
+                # The caller's own deadline ran out while the dependency was still busy
+                self.timeouts += 1
+                self._record(False, probe, "caller gave up waiting")
+            raise
+        except self.expected_errors:
+            self._record(True, probe)
+            raise
+        except Exception as e:
+            self._record(False, probe, f"{type(e).__name__}: {e}")
+            raise
+        self._record(True, probe)
+        return result
+
+    def snapshot(self) -> dict:
+        """Current state for the health endpoint."""
+        now = time.monotonic()
+        self._prune(now)
+        calls = len(self.outcomes)
+        failures = sum(1 for _, success in self.outcomes if not success)
+        snapshot = {
+            "state": self.state,
+            "window_calls": calls,
+            "window_failure_rate": round(failures / calls, 3) if calls else 0.0,
+            "in_flight": self.in_flight,
+            "max_concurrent": self.settings.max_concurrent,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "last_error": self.last_error,
+        }
+        if self.state == OPEN:
+            snapshot["retry_in_seconds"] = round(max(0.0, self.opened_at + self.settings.open_seconds - now), 1)
+        return snapshot
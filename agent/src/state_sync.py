@@ -0,0 +1,55 @@
+"""
+AG-UI state synchronisation with JSON Patch deltas.
+Tools that change shared state report it as a minimal RFC 6902 patch against
+the last state the frontend is known to hold. A full snapshot is only sent
+when there is no such baseline (new session or a client asking to resync).
+"""
+
+from typing import Any, Optional
+
+from ag_ui.core import BaseEvent, EventType, StateDeltaEvent, StateSnapshotEvent
+
+
+def _pointer(path: str, key: Any) -> str:
+    """Append a key to a JSON Pointer (RFC 6901 escaping)."""
+    return f"{path}/{str(key).replace('~', '~0').replace('/', '~1')}"
+
+
+def json_patch(old: Any, new: Any, path: str = "") -> list[dict]:
+    """
+    Compute JSON Patch operations turning `old` into `new`.
+    Objects are diffed key by key; same-length lists element by element;
+    anything else that differs is replaced wholesale.
+    """
+    if old == new:
+        return []
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = []
+        for key in old:
+            if key not in new:
+                ops.append({"op": "remove", "path": _pointer(path, key)})
+        for key, value in new.items():
+            if key not in old:
+                ops.append({"op": "add", "path": _pointer(path, key), "value": value})
+            else:
+                ops.extend(json_patch(old[key], value, _pointer(path, key)))
+        return ops
+    if isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        ops = []
+        for index, (a, b) in enumerate(zip(old, new)):
+            ops.extend(json_patch(a, b, _pointer(path, index)))
+        return ops
+    return [{"op": "replace", "path": path or "", "value": new}]
+
+
+def state_sync_events(current: dict, client_view: Optional[dict]) -> list[BaseEvent]:
+    """
+    Events that bring the frontend from `client_view` to `current`:
+    nothing if unchanged, a STATE_DELTA patch normally, a STATE_SNAPSHOT on resync.
+    """
+    if client_view is None:
+        return [StateSnapshotEvent(type=EventType.STATE_SNAPSHOT, snapshot=current)]
+    ops = json_patch(client_view, current)
+    if not ops:
+        return []
+    return [StateDeltaEvent(type=EventType.STATE_DELTA, delta=ops)]
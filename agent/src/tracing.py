@@ -0,0 +1,156 @@
+"""
+Session trace capture for offline replay.
+When TRACE_CAPTURE_DIR is set, every /chat/completions and /agui request is
+written as one compact JSONL line: request body, resolved identity, what the
+Zep and Neon reads returned, each model response (with its tool calls and
+arguments) and the tool results fed back to the model. See replay.py for
+running traces against the app.
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Optional
+
+from pydantic_ai.messages import ModelMessagesTypeAdapter, ModelRequest, ToolReturnPart
+from pydantic_ai.models.wrapper import WrapperModel
+
+TRACE_CAPTURE_DIR = os.environ.get("TRACE_CAPTURE_DIR")
+TRACED_PATHS = ("/chat/completions", "/agui")
+
+_current_trace: ContextVar[Optional[dict]] = ContextVar("current_trace", default=None)
+
+
+def dump_message(message) -> dict:
+    return ModelMessagesTypeAdapter.dump_python([message], mode="json")[0]
+
+
+def load_message(data: dict):
+    return ModelMessagesTypeAdapter.validate_python([data])[0]
+
+
+def record_identity(user_name: str, user_id: str):
+    """Attach the resolved identity to the trace of the current request (no-op if not capturing)."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace["identity"] = {"user_name": user_name, "user_id": user_id}
+
+
+def record_source(name: str, value):
+    """Attach what an external read returned (profile, Zep facts) so replay can serve it (no-op if not capturing)."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace["sources"][name] = value
+
+
+def record_usage(usage: dict):
+    """Attach the request's model usage summary to its trace (no-op if not capturing)."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace["usage"] = usage
+
+
+class RecordingModel(WrapperModel):
+    """Model wrapper that appends each model call to the current request's trace."""
+
+    def _record(self, messages: list, response):
+        trace = _current_trace.get()
+        if trace is None:
+            return
+        tool_returns = []
+        if messages and isinstance(messages[-1], ModelRequest):
+            tool_returns = [
+                {"tool_name": part.tool_name, "tool_call_id": part.tool_call_id, "content": part.model_response_str()}
+                for part in messages[-1].parts if isinstance(part, ToolReturnPart)
+            ]
+        trace["model_calls"].append({"tool_returns": tool_returns, "response": dump_message(response)})
+
+    async def request(self, messages, *args, **kwargs):
+        response = await super().request(messages, *args, **kwargs)
+        self._record(messages, response)
+        return response
+
+    @asynccontextmanager
+    async def request_stream(self, messages, *args, **kwargs):
+        async with super().request_stream(messages, *args, **kwargs) as stream:
+            yield stream
+        self._record(messages, stream.get())
+
+
+class TraceCaptureMiddleware:
+    """ASGI middleware that buffers the request body and writes one trace line per request."""
+
+    def __init__(self, app, directory: str = TRACE_CAPTURE_DIR):
+        self.app = app
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path", "")
+        if scope["type"] != "http" or scope.get("method") != "POST" or not path.startswith(TRACED_PATHS):
+            return await self.app(scope, receive, send)
+
+        chunks = []
+        more = True
+        while more:
+            message = await receive()
+            chunks.append(message.get("body", b""))
+            more = message.get("more_body", False)
+        body = b"".join(chunks)
+
+        replayed = False
+
+        async def replay_receive():
+            nonlocal replayed
+            if not replayed:
+                replayed = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        status = {}
+
+        async def capture_send(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        try:
+            request_body = json.loads(body) if body else None
+        except ValueError:
+            request_body = body.decode("utf-8", "replace")
+
+        trace = {
+            "ts": time.time(),
+            "path": path,
+            "body": request_body,
+            "identity": None,
+            "sources": {},
+            "model_calls": [],
+        }
+        # AG-UI carries the user in the shared state; the CLM endpoint calls record_identity()
+        if isinstance(request_body, dict) and isinstance(request_body.get("state"), dict):
+            user = request_body["state"].get("user") or {}
+            if user:
+                trace["identity"] = {"user_name": user.get("name") or "", "user_id": user.get("id") or ""}
+        token = _current_trace.set(trace)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, replay_receive, capture_send)
+        finally:
+            _current_trace.reset(token)
+            trace["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            trace["status"] = status.get("code")
+            await asyncio.to_thread(self._write, trace)
+
+    def _write(self, trace: dict):
+        filename = self.directory / f"traces-{time.strftime('%Y%m%d')}.jsonl"
+        try:
+            with open(filename, "a", encoding="utf-8") as f:
+                f.write(json.dumps(trace, separators=(",", ":"), ensure_ascii=False, default=str) + "\n")
+        except OSError as e:
+            print(f"[TRACE] Write error: {e}", file=sys.stderr)
@@ -0,0 +1,103 @@
+"""
+Shared HTTP transport for the Gemini and Zep provider clients.
+Each provider gets its own pooled keep-alive client (so limits are per host),
+with HTTP/2 when the h2 package is installed. Clients are created and closed
+by the FastAPI lifespan.
+"""
+
+import os
+import sys
+from dataclasses import dataclass
+from typing import Optional
+
+import httpx
+
+
+def http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+@dataclass(frozen=True)
+class PoolSettings:
+    """Connection pool and timeout settings for one upstream host."""
+    max_connections: int
+    max_keepalive: int
+    keepalive_expiry: float
+    connect_timeout: float
+    read_timeout: float
+    pool_timeout: float
+
+    @classmethod
+    def from_env(cls, prefix: str, **defaults) -> "PoolSettings":
+        """Read e.g. GEMINI_HTTP_MAX_CONNECTIONS, falling back to the given defaults."""
+        values = {}
+        for name, default in defaults.items():
+            raw = os.environ.get(f"{prefix}_HTTP_{name.upper()}")
+            values[name] = type(default)(raw) if raw else default
+        return cls(**values)
+
+    def limits(self) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+
+    def timeout(self) -> httpx.Timeout:
+        return httpx.Timeout(
+            connect=self.connect_timeout,
+            read=self.read_timeout,
+            write=self.read_timeout,
+            pool=self.pool_timeout,
+        )
+
+
+GEMINI_POOL = PoolSettings.from_env(
+    "GEMINI",
+    max_connections=50, max_keepalive=20, keepalive_expiry=60.0,
+    connect_timeout=5.0, read_timeout=60.0, pool_timeout=5.0,
+)
+ZEP_POOL = PoolSettings.from_env(
+    "ZEP",
+    max_connections=20, max_keepalive=10, keepalive_expiry=60.0,
+    connect_timeout=3.0, read_timeout=10.0, pool_timeout=3.0,
+)
+
+
+class ClientPool:
+    """Owns the pooled HTTP clients for the provider SDKs."""
+
+    def __init__(self, gemini: PoolSettings = GEMINI_POOL, zep: PoolSettings = ZEP_POOL):
+        self.gemini_settings = gemini
+        self.zep_settings = zep
+        self.gemini_http: Optional[httpx.AsyncClient] = None
+        self.zep_http: Optional[httpx.Client] = None
+
+    def open(self):
+        """Create both clients (idempotent)."""
+        http2 = http2_available()
+        if self.gemini_http is None or self.gemini_http.is_closed:
+            self.gemini_http = httpx.AsyncClient(
+                http2=http2,
+                limits=self.gemini_settings.limits(),
+                timeout=self.gemini_settings.timeout(),
+            )
+        if self.zep_http is None or self.zep_http.is_closed:
+            # The Zep SDK is synchronous and called from worker threads; httpx.Client is thread-safe
+            self.zep_http = httpx.Client(
+                http2=http2,
+                limits=self.zep_settings.limits(),
+                timeout=self.zep_settings.timeout(),
+            )
+        print(f"[HTTP] Client pools open (http2={http2})", file=sys.stderr)
+
+    async def aclose(self):
+        if self.gemini_http is not None:
+            await self.gemini_http.aclose()
+        if self.zep_http is not None:
+            self.zep_http.close()
+        print("[HTTP] Client pools closed", file=sys.stderr)
@@ -0,0 +1,259 @@
+"""
+Per-request LLM usage and round-trip accounting.
+Every model call made while serving /chat/completions or /agui is counted against
+that request: model requests, input/output tokens, tool calls by name and model
+wall time. Finished requests are aggregated per endpoint, per user tier
+(anonymous / logged_in) and per tool, and model turns are summed per session so
+a budget alarm fires when one conversation goes over SESSION_MODEL_TURN_BUDGET.
+Requests answered without a model call (rejected bodies, idempotent replays)
+are only counted, so they don't dilute the per-run averages.
+"""
+
+import os
+import sys
+import json
+import time
+from collections import Counter, OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Optional
+
+from pydantic_ai.messages import ToolCallPart
+from pydantic_ai.models.wrapper import WrapperModel
+
+from .tracing import record_usage
+
+SESSION_MODEL_TURN_BUDGET = int(os.environ.get("SESSION_MODEL_TURN_BUDGET", "20"))
+USAGE_MAX_SESSIONS = int(os.environ.get("USAGE_MAX_SESSIONS", "10000"))
+USAGE_PATHS = ("/chat/completions", "/agui")
+
+ANONYMOUS = "anonymous"
+LOGGED_IN = "logged_in"
+
+_current_usage: ContextVar[Optional["UsageRecord"]] = ContextVar("current_usage", default=None)
+
+
+@dataclass(slots=True)
+class UsageRecord:
+    """Model usage of one request (one agent run)."""
+    endpoint: str
+    tier: Optional[str] = None
+    session_id: Optional[str] = None
+    model_requests: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    model_ms: float = 0.0
+    tool_calls: Counter = field(default_factory=Counter)
+
+    def add_response(self, response, elapsed_ms: float):
+        self.model_requests += 1
+        self.input_tokens += response.usage.input_tokens or 0
+        self.output_tokens += response.usage.output_tokens or 0
+        self.model_ms += elapsed_ms
+        for part in response.parts:
+            if isinstance(part, ToolCallPart):
+                self.tool_calls[part.tool_name] += 1
+
+    def to_dict(self) -> dict:
+        return {
+            "endpoint": self.endpoint,
+            "tier": self.tier,
+            "session_id": self.session_id,
+            "model_requests": self.model_requests,
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "model_ms": round(self.model_ms, 1),
+            "tool_calls": dict(self.tool_calls),
+        }
+
+
+@dataclass(slots=True)
+class UsageTotals:
+    """Running totals over many requests."""
+    runs: int = 0
+    model_requests: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    model_ms: float = 0.0
+    tool_calls: int = 0
+
+    def add(self, record: UsageRecord):
+        self.runs += 1
+        self.model_requests += record.model_requests
+        self.input_tokens += record.input_tokens
+        self.output_tokens += record.output_tokens
+        self.model_ms += record.model_ms
+        self.tool_calls += sum(record.tool_calls.values())
+
+    def to_dict(self) -> dict:
+        runs = self.runs or 1
+        return {
+            "runs": self.runs,
+            "model_requests": self.model_requests,
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "model_ms": round(self.model_ms, 1),
+            "tool_calls": self.tool_calls,
+            "avg_model_requests": round(self.model_requests / runs, 2),
+            "avg_tokens": round((self.input_tokens + self.output_tokens) / runs, 1),
+            "avg_model_ms": round(self.model_ms / runs, 1),
+        }
+
+
+class UsageLedger:
+    """In-process aggregates plus per-session model turn counts for the budget alarm."""
+
+    def __init__(self, turn_budget: int = SESSION_MODEL_TURN_BUDGET, max_sessions: int = USAGE_MAX_SESSIONS):
+        self.turn_budget = turn_budget
+        self.max_sessions = max_sessions
+        self.started = time.time()
+        self.by_endpoint: dict[str, UsageTotals] = {}
+        self.by_tier: dict[str, UsageTotals] = {}
+        self.by_tool: dict[str, UsageTotals] = {}
+        self.tool_calls: Counter = Counter()
+        # Requests per endpoint answered without a model call (422s, cached replays)
+        self.no_model_calls: Counter = Counter()
+        # session_id -> (model turns so far, alarm already raised)
+        self.sessions: OrderedDict[str, tuple[int, bool]] = OrderedDict()
+        self.alarm_count = 0
+        self.alarms: deque[dict] = deque(maxlen=50)
+
+    def record(self, record: UsageRecord) -> Optional[dict]:
+        """Aggregate a finished request; returns the alarm it raised, if any."""
+        if not record.model_requests:
+            self.no_model_calls[record.endpoint] += 1
+            return None
+        self.by_endpoint.setdefault(record.endpoint, UsageTotals()).add(record)
+        self.by_tier.setdefault(record.tier or ANONYMOUS, UsageTotals()).add(record)
+        for tool in record.tool_calls:
+            # Per tool: the requests that used it, so their turn and token counts can be compared
+            self.by_tool.setdefault(tool, UsageTotals()).add(record)
+        self.tool_calls.update(record.tool_calls)
+        return self._check_budget(record)
+
+    def _check_budget(self, record: UsageRecord) -> Optional[dict]:
+        turns, alarmed = record.model_requests, False
+        if record.session_id:
+            previous, alarmed = self.sessions.pop(record.session_id, (0, False))
+            turns += previous
+        if turns > self.turn_budget and not alarmed:
+            alarmed = True
+            alarm = {
+                "ts": time.time(),
+                "session_id": record.session_id,
+                "endpoint": record.endpoint,
+                "tier": record.tier,
+                "model_turns": turns,
+                "budget": self.turn_budget,
+            }
+            self.alarm_count += 1
+            self.alarms.append(alarm)
+            print(f"[USAGE] ALARM session {record.session_id or '-'} on {record.endpoint}: "
+                  f"{turns} model turns > budget {self.turn_budget}", file=sys.stderr)
+        else:
+            alarm = None
+        if record.session_id:
+            self.sessions[record.session_id] = (turns, alarmed)
+            if len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+        return alarm
+
+    def snapshot(self) -> dict:
+        return {
+            "since": self.started,
+            "session_model_turn_budget": self.turn_budget,
+            "by_endpoint": {k: v.to_dict() for k, v in self.by_endpoint.items()},
+            "by_tier": {k: v.to_dict() for k, v in self.by_tier.items()},
+            "by_tool": {k: {"calls": self.tool_calls[k], **v.to_dict()} for k, v in self.by_tool.items()},
+            "requests_without_model_calls": dict(self.no_model_calls),
+            "budget_alarms": self.alarm_count,
+            "recent_alarms": list(self.alarms),
+        }
+
+
+usage_ledger = UsageLedger()
+
+
+def current_usage() -> Optional[UsageRecord]:
+    return _current_usage.get()
+
+
+def record_usage_identity(session_id: Optional[str], user_id: Optional[str]):
+    """Attach session and tier to the current request's usage (no-op outside tracked paths)."""
+    record = _current_usage.get()
+    if record is not None:
+        record.session_id = session_id or None
+        record.tier = LOGGED_IN if user_id else ANONYMOUS
+
+
+class UsageModel(WrapperModel):
+    """Model wrapper that adds each call's tokens, tool calls and wall time to the current request."""
+
+    def _add(self, response, started: float):
+        record = _current_usage.get()
+        if record is not None:
+            record.add_response(response, (time.perf_counter() - started) * 1000)
+
+    async def request(self, *args, **kwargs):
+        started = time.perf_counter()
+        response = await super().request(*args, **kwargs)
+        self._add(response, started)
+        return response
+
+    @asynccontextmanager
+    async def request_stream(self, *args, **kwargs):
+        started = time.perf_counter()
+        async with super().request_stream(*args, **kwargs) as stream:
+            yield stream
+        self._add(stream.get(), started)
+
+
+class UsageMiddleware:
+    """
+    ASGI middleware that opens a UsageRecord per agent request and aggregates it at the end.
+    The CLM endpoint sets session and tier via record_usage_identity(); for AG-UI they are
+    read from the request body (threadId, state.user.id) once the request has finished.
+    """
+
+    def __init__(self, app, ledger: UsageLedger = usage_ledger):
+        self.app = app
+        self.ledger = ledger
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path", "")
+        if scope["type"] != "http" or scope.get("method") != "POST" or not path.startswith(USAGE_PATHS):
+            return await self.app(scope, receive, send)
+
+        endpoint = "/agui" if path.startswith("/agui") else path
+        record = UsageRecord(endpoint=endpoint)
+        chunks = []
+
+        async def tee_receive():
+            message = await receive()
+            if record.tier is None and message["type"] == "http.request":
+                chunks.append(message.get("body", b""))
+            return message
+
+        token = _current_usage.set(record)
+        try:
+            await self.app(scope, tee_receive if endpoint == "/agui" else receive, send)
+        finally:
+            _current_usage.reset(token)
+            if record.tier is None:
+                self._identity_from_body(record, b"".join(chunks))
+            self.ledger.record(record)
+            record_usage(record.to_dict())
+
+    @staticmethod
+    def _identity_from_body(record: UsageRecord, body: bytes):
+        try:
+            data = json.loads(body) if body else {}
+        except ValueError:
+            data = {}
+        if not isinstance(data, dict):
+            data = {}
+        state = data.get("state") if isinstance(data.get("state"), dict) else {}
+        user = state.get("user") if isinstance(state.get("user"), dict) else {}
+        record.session_id = data.get("threadId") or None
+        record.tier = LOGGED_IN if user.get("id") else ANONYMOUS
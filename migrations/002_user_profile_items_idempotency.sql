@@ -0,0 +1,10 @@
+-- Idempotent calculation saves
+-- Run this migration against your Neon database before deploying the agent change
+-- that writes idempotency_key. A retried CLM turn calls save_calculation with the
+-- same key; the unique index makes the second insert a no-op (ON CONFLICT DO NOTHING).
+
+ALTER TABLE user_profile_items ADD COLUMN IF NOT EXISTS idempotency_key VARCHAR(64);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_user_profile_items_idempotency
+    ON user_profile_items(user_id, idempotency_key)
+    WHERE idempotency_key IS NOT NULL;